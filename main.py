@@ -4,18 +4,27 @@ import random
 import os
 import time
 import string
+import re
+import hashlib
+import json
+import ssl
 from datetime import datetime, timedelta, date
 from typing import Dict, List, Optional, Tuple, Any
-from collections import defaultdict
+from collections import defaultdict, deque
 import asyncpg
+import aiohttp
+import certifi
 from aiohttp import web
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
+# Сам модуль не импортирует redis: клиент нужен только при создании хранилища (REDIS_URL)
+from aiogram.contrib.fsm_storage.redis import RedisStorage2
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils import executor
+from aiogram.utils.callback_data import CallbackData
 from aiogram.utils.exceptions import (
     BotBlocked, UserDeactivated, ChatNotFound, RetryAfter,
     TelegramAPIError, MessageNotModified, MessageToEditNotFound,
@@ -36,6 +45,16 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL не задан. Создай PostgreSQL базу в Railway.")
 
+# Необязательно: хранить состояния FSM в Redis (нужно для нескольких экземпляров бота)
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Необязательно: публичный адрес сервиса (https://...). Если задан, бот работает на вебхуке
+# вместо long polling, и Telegram присылает обновления в тот же веб-сервер, что и health-check
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")
+# Путь не угадать без токена, а сам токен в URL не попадает
+WEBHOOK_PATH = "/tg/" + hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+PORT = int(os.getenv("PORT", 8080))
+
 # Значения по умолчанию для настроек
 DEFAULT_SETTINGS = {
     "random_attack_cost": "0",
@@ -103,6 +122,11 @@ MIN_PLAYERS = 2
 MAX_PLAYERS = 5
 MIN_BET = 3
 DEALER_WIN_RATE = 3
+BROADCAST_CONCURRENCY = 25  # воркеров рассылки
+BROADCAST_RATE = 28  # сообщений в секунду на всю рассылку (лимит Telegram ~30/с)
+BROADCAST_STATUS_INTERVAL = 3  # раз во столько секунд обновляется сообщение с прогрессом
+BROADCAST_FETCH_BATCH = 1000  # получателей рассылки читаем из БД порциями по столько
+TG_CONNECTIONS_LIMIT = 100  # одновременных HTTP-соединений к Bot API: воркеры рассылки + обычные ответы
 
 # ===== ИНИЦИАЛИЗАЦИЯ =====
 logging.basicConfig(
@@ -117,13 +141,110 @@ channels_cache = []
 last_channels_update = 0
 confirmed_chats_cache = {}
 last_confirmed_chats_update = 0
+banned_ids_cache = None
+last_banned_update = 0
+admin_ids_cache = None
+last_admins_update = 0
+active_tasks_cache = None
+last_tasks_update = 0
+# Бот может работать в нескольких экземплярах (вебхук + Redis-хранилище), поэтому кэши
+# в памяти — это ускорение с задержкой до TTL, а всё, от чего зависят деньги, перепроверяется в БД.
+# Когда кэш устаревает, его перезагружает один запрос, а остальные ждут результат
+settings_lock = asyncio.Lock()
+admin_ids_lock = asyncio.Lock()
+banned_ids_lock = asyncio.Lock()
+active_tasks_lock = asyncio.Lock()
+# Черновики многошаговых форм создания: (chat_id, user_id) -> (время начала, dict).
+# В FSM-хранилище по шагам ничего не пишется; итог сохраняется в БД одним запросом
+# в on_finish. После перезапуска или на другом экземпляре черновика нет — форму заполняют заново
+form_drafts = {}
+FORM_DRAFT_TTL = 3600
 
 async def before_start():
-    await bot.delete_webhook(drop_pending_updates=True)
-    logging.info("Webhook удалён, пропущены старые обновления")
+    if WEBHOOK_HOST:
+        await bot.set_webhook(WEBHOOK_HOST.rstrip("/") + WEBHOOK_PATH, drop_pending_updates=True)
+        logging.info("Webhook установлен, пропущены старые обновления")
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+        logging.info("Webhook удалён, пропущены старые обновления")
+
+class PipelinedRedisStorage(RedisStorage2):
+    """RedisStorage2, где данные FSM лежат в хэше (поле -> JSON).
+
+    Штатный update_data делает GET, слияние в Python и SET — два запроса к Redis
+    на каждый шаг. С хэшем слияние делает сам Redis: HSET и EXPIRE уходят одним
+    конвейером без предварительного чтения.
+    """
+    def _data_key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        # Отдельный ключ: строковые данные старого формата не дадут WRONGTYPE
+        return self.generate_key(chat, user, "hdata")
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        raw = await self._redis.hgetall(self._data_key(chat, user))
+        if raw:
+            return {name: json.loads(value) for name, value in raw.items()}
+        return default or {}
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key = self._data_key(chat, user)
+        # Замена целиком — в MULTI, чтобы параллельное чтение не увидело пустой хэш
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            if data:
+                pipe.hset(key, mapping={name: json.dumps(value) for name, value in data.items()})
+                if self._data_ttl:
+                    pipe.expire(key, self._data_ttl)
+            await pipe.execute()
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        fields = dict(data or {}, **kwargs)
+        if not fields:
+            return
+        key = self._data_key(chat, user)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping={name: json.dumps(value) for name, value in fields.items()})
+            if self._data_ttl:
+                pipe.expire(key, self._data_ttl)
+            await pipe.execute()
+
+def create_storage():
+    if not REDIS_URL:
+        return MemoryStorage()
+    from urllib.parse import urlparse
+    url = urlparse(REDIS_URL)
+    logging.info("FSM-хранилище: Redis")
+    return PipelinedRedisStorage(
+        host=url.hostname or "localhost",
+        port=url.port or 6379,
+        db=int(url.path.lstrip("/") or 0),
+        password=url.password,
+        ssl=True if url.scheme == "rediss" else None,
+        pool_size=50
+    )
 
-bot = Bot(token=BOT_TOKEN, parse_mode="HTML")
-storage = MemoryStorage()
+class KeepAliveBot(Bot):
+    """Bot, чья aiohttp-сессия держит соединения с Bot API дольше.
+
+    По умолчанию простаивающее соединение закрывается через 15 с, и после паузы каждый
+    запрос снова проходит TLS-рукопожатие. get_new_session — публичная точка расширения
+    BaseBot в aiogram 2.x (проверено на 2.25.1): через неё aiogram создаёт и пересоздаёт
+    сессию, так что коннектор собирается здесь явно, без правки приватных атрибутов.
+    """
+    async def get_new_session(self) -> aiohttp.ClientSession:
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=TG_CONNECTIONS_LIMIT,
+                # Тот же контекст, что aiogram собирает по умолчанию
+                ssl=ssl.create_default_context(cafile=certifi.where()),
+                keepalive_timeout=75,
+                ttl_dns_cache=300
+            ),
+            json_serialize=json.dumps
+        )
+
+bot = KeepAliveBot(token=BOT_TOKEN, parse_mode="HTML", connections_limit=TG_CONNECTIONS_LIMIT)
+storage = create_storage()
 dp = Dispatcher(bot, storage=storage)
 
 # ===== МИДЛВАРЬ ДЛЯ ЗАЩИТЫ ОТ ФЛУДА =====
@@ -146,8 +267,56 @@ class ThrottlingMiddleware(BaseMiddleware):
 dp.middleware.setup(ThrottlingMiddleware(rate_limit=0.5))
 
 # ===== БЕЗОПАСНАЯ ОТПРАВКА СООБЩЕНИЙ =====
+class RateLimiter:
+    """Не больше rate вызовов acquire() в секунду, равномерно разнесённых во времени."""
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.next_slot = 0.0
+
+    async def acquire(self):
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+class TGRateLimiter:
+    """Лимиты Telegram на исходящие: общий темп на весь бот и не больше chat_limit сообщений в одну группу за chat_period секунд."""
+    def __init__(self, rate: float, chat_limit: int = 20, chat_period: float = 60):
+        self.global_limiter = RateLimiter(rate)
+        self.chat_limit = chat_limit
+        self.chat_period = chat_period
+        self.chat_sends = defaultdict(deque)
+        self.last_sweep = 0.0
+
+    async def acquire(self, chat_id: int):
+        # Окно «N сообщений в минуту» у Telegram действует для групп; в личку — только общий темп
+        if chat_id >= 0:
+            await self.global_limiter.acquire()
+            return
+        loop = asyncio.get_running_loop()
+        sends = self.chat_sends[chat_id]
+        while True:
+            now = loop.time()
+            while sends and now - sends[0] >= self.chat_period:
+                sends.popleft()
+            if len(sends) < self.chat_limit:
+                break
+            await asyncio.sleep(sends[0] + self.chat_period - now)
+        sends.append(now)
+        if now - self.last_sweep > self.chat_period:
+            # После рассылки в словаре остаются тысячи чатов — выкидываем давно молчащие
+            self.last_sweep = now
+            for cid in [c for c, q in self.chat_sends.items() if now - q[-1] >= self.chat_period]:
+                del self.chat_sends[cid]
+        await self.global_limiter.acquire()
+
+# Один лимитер на все исходящие: уведомления и рассылка делят общий бюджет
+tg_limiter = TGRateLimiter(BROADCAST_RATE)
+
 async def safe_send_message(user_id: int, text: str, **kwargs):
     try:
+        await tg_limiter.acquire(user_id)
         await bot.send_message(user_id, text, **kwargs)
     except BotBlocked:
         logging.warning(f"Bot blocked by user {user_id}")
@@ -167,12 +336,37 @@ async def safe_send_message(user_id: int, text: str, **kwargs):
     except Exception as e:
         logging.warning(f"Failed to send message to {user_id}: {e}")
 
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора до завершения
+background_tasks = set()
+
+def _background_task_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.error(f"Background task error: {task.exception()}")
+
 def safe_send_message_task(user_id: int, text: str, **kwargs):
-    asyncio.create_task(safe_send_message(user_id, text, **kwargs))
+    # Уведомление без ожидания: ответ админу не ждёт отправки пользователю
+    task = asyncio.create_task(safe_send_message(user_id, text, **kwargs))
+    background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+
+def safe_send_chat_task(chat_id: int, text: str, **kwargs):
+    # Сообщение в группу может ждать окна лимита до минуты — хендлер и соединение с БД его не ждут
+    task = asyncio.create_task(safe_send_chat(chat_id, text, **kwargs))
+    background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
 
 async def safe_send_chat(chat_id: int, text: str, **kwargs):
     try:
+        await tg_limiter.acquire(chat_id)
         await bot.send_message(chat_id, text, **kwargs)
+    except RetryAfter as e:
+        logging.warning(f"Flood limit in chat {chat_id}. Retry after {e.timeout} seconds")
+        await asyncio.sleep(e.timeout)
+        try:
+            await bot.send_message(chat_id, text, **kwargs)
+        except Exception as ex:
+            logging.error(f"Failed to send to chat {chat_id} after retry: {ex}")
     except Exception as e:
         logging.error(f"Failed to send to chat {chat_id}: {e}")
 
@@ -183,12 +377,130 @@ async def create_db_pool():
         DATABASE_URL,
         min_size=5,
         max_size=20,
-        command_timeout=60,
+        # Зависший запрос не держит соединение из пула дольше 30 секунд
+        command_timeout=30,
         max_queries=50000,
-        max_inactive_connection_lifetime=300
+        max_inactive_connection_lifetime=300,
+        # asyncpg сам готовит и кэширует запросы на каждом соединении, но по умолчанию
+        # помнит только 100 — у бота их больше двухсот, и горячие вытеснялись бы из LRU
+        statement_cache_size=512,
+        # Запросы бота короткие: JIT на них только тратит время на компиляцию,
+        # а application_name помогает найти соединения бота в pg_stat_activity
+        server_settings={'jit': 'off', 'application_name': 'bot2'}
     )
     logging.info("Подключение к PostgreSQL установлено")
 
+class InsertCoalescer:
+    """Копит одиночные INSERT'ы и сбрасывает их в таблицу одним многострочным запросом.
+
+    Имеет смысл только там, где вставки идут пачкой из параллельных обработчиков
+    (всплеск нажатий «Участвовать» после анонса розыгрыша): каждый вызов ждёт
+    сброса пакета, то есть до delay секунд.
+    """
+    def __init__(self, delay=0.05, max_batch=200):
+        self.delay = delay
+        self.max_batch = max_batch
+        self.buffers = defaultdict(list)
+        # Таймеры, которые ещё спят, — по ключу пакета
+        self.flush_tasks = {}
+        # Все запущенные сбросы (по таймеру и по заполнению) — их дожидается flush_all
+        self.pending_flushes = set()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.pending_flushes.add(task)
+        task.add_done_callback(self.pending_flushes.discard)
+        return task
+
+    async def enqueue(self, table: str, columns: tuple, row: tuple, conflict: tuple = None) -> bool:
+        # Ждём реального сброса пакета, чтобы вызывающий видел ошибки своей строки.
+        # С conflict (столбцы ключа) дубликаты пропускаются (ON CONFLICT DO NOTHING) и возвращается False
+        key = (table, columns, conflict)
+        fut = asyncio.get_running_loop().create_future()
+        self.buffers[key].append((row, fut))
+        if len(self.buffers[key]) >= self.max_batch:
+            task = self.flush_tasks.pop(key, None)
+            if task:
+                task.cancel()
+            self._spawn(self.flush(key))
+        elif key not in self.flush_tasks:
+            self.flush_tasks[key] = self._spawn(self._flush_later(key))
+        return await fut
+
+    async def _flush_later(self, key):
+        await asyncio.sleep(self.delay)
+        self.flush_tasks.pop(key, None)
+        await self.flush(key)
+
+    async def flush(self, key):
+        batch = self.buffers.pop(key, [])
+        if not batch:
+            return
+        table, columns, conflict = key
+        width = len(columns)
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES "
+        values = ", ".join(
+            "(" + ", ".join(f"${i * width + j + 1}" for j in range(width)) + ")"
+            for i in range(len(batch))
+        )
+        suffix = ""
+        if conflict:
+            suffix = f" ON CONFLICT ({', '.join(conflict)}) DO NOTHING RETURNING {', '.join(conflict)}"
+            positions = [columns.index(c) for c in conflict]
+
+        def resolve(pairs, inserted):
+            for row, fut in pairs:
+                if conflict:
+                    # Повтор ключа внутри пакета тоже считается конфликтом
+                    value = tuple(row[p] for p in positions)
+                    ok = value in inserted
+                    inserted.discard(value)
+                else:
+                    ok = True
+                if not fut.done():
+                    fut.set_result(ok)
+
+        try:
+            async with db_pool.acquire() as conn:
+                try:
+                    records = await conn.fetch(sql + values + suffix, *[v for row, _ in batch for v in row])
+                    resolve(batch, {tuple(r) for r in records})
+                    return
+                except Exception:
+                    if len(batch) == 1:
+                        raise
+                # Одна плохая строка откатывает весь пакет — повторяем построчно
+                single = sql + "(" + ", ".join(f"${j + 1}" for j in range(width)) + ")" + suffix
+                for row, fut in batch:
+                    try:
+                        records = await conn.fetch(single, *row)
+                        resolve([(row, fut)], {tuple(r) for r in records})
+                    except Exception as e:
+                        if not fut.done():
+                            fut.set_exception(e)
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+        finally:
+            # Сброс отменили (CancelledError — не Exception): вызывающие не должны ждать вечно
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(RuntimeError(f"Вставка в {table} прервана"))
+
+    async def flush_all(self):
+        # Спящие таймеры отменяем — их буферы сбросим сами; уже идущие сбросы дожидаемся,
+        # иначе пул закроется под ними
+        for task in self.flush_tasks.values():
+            task.cancel()
+        self.flush_tasks.clear()
+        if self.pending_flushes:
+            await asyncio.gather(*list(self.pending_flushes), return_exceptions=True)
+        for key in list(self.buffers):
+            await self.flush(key)
+
+insert_coalescer = InsertCoalescer()
+
 async def init_db():
     async with db_pool.acquire() as conn:
         # Таблица users
@@ -262,8 +574,8 @@ async def init_db():
                 level INTEGER,
                 hp INTEGER,
                 max_hp INTEGER,
-                spawned_at TEXT,
-                expires_at TEXT,
+                spawned_at TIMESTAMP,
+                expires_at TIMESTAMP,
                 reward_coins INTEGER,
                 participants BIGINT[] DEFAULT '{}',
                 status TEXT DEFAULT 'active'
@@ -276,10 +588,14 @@ async def init_db():
                 boss_id INTEGER,
                 user_id BIGINT,
                 damage INTEGER,
-                attack_time TEXT,
+                attack_time TIMESTAMP,
                 PRIMARY KEY (boss_id, user_id)
             )
         ''')
+        # Время босса и атак раньше хранилось как TEXT
+        await migrate_column_to_timestamp(conn, 'bosses', 'spawned_at')
+        await migrate_column_to_timestamp(conn, 'bosses', 'expires_at')
+        await migrate_column_to_timestamp(conn, 'boss_attacks', 'attack_time')
 
         # Остальные таблицы
         await conn.execute('''
@@ -340,7 +656,7 @@ async def init_db():
                 id SERIAL PRIMARY KEY,
                 prize TEXT,
                 description TEXT,
-                end_date TEXT,
+                end_date TIMESTAMP,
                 media_file_id TEXT,
                 media_type TEXT,
                 status TEXT DEFAULT 'active',
@@ -356,21 +672,25 @@ async def init_db():
                 PRIMARY KEY (user_id, giveaway_id)
             )
         ''')
+        # end_date раньше хранился как TEXT
+        await migrate_column_to_timestamp(conn, 'giveaways', 'end_date')
         await conn.execute('''
             CREATE TABLE IF NOT EXISTS admins (
                 user_id BIGINT PRIMARY KEY,
                 added_by BIGINT,
-                added_date TEXT
+                added_date TIMESTAMP DEFAULT LOCALTIMESTAMP(0)
             )
         ''')
         await conn.execute('''
             CREATE TABLE IF NOT EXISTS banned_users (
                 user_id BIGINT PRIMARY KEY,
                 banned_by BIGINT,
-                banned_date TEXT,
+                banned_date TIMESTAMP DEFAULT LOCALTIMESTAMP(0),
                 reason TEXT
             )
         ''')
+        await migrate_column_to_timestamp(conn, 'admins', 'added_date', default='LOCALTIMESTAMP(0)')
+        await migrate_column_to_timestamp(conn, 'banned_users', 'banned_date', default='LOCALTIMESTAMP(0)')
         await conn.execute('''
             CREATE TABLE IF NOT EXISTS settings (
                 key TEXT PRIMARY KEY,
@@ -398,11 +718,12 @@ async def init_db():
                 user_id BIGINT,
                 task_id INTEGER,
                 completed_at TEXT,
-                expires_at TEXT,
+                expires_at TIMESTAMP,
                 status TEXT DEFAULT 'completed',
                 PRIMARY KEY (user_id, task_id)
             )
         ''')
+        await migrate_column_to_timestamp(conn, 'user_tasks', 'expires_at')
         await conn.execute('''
             CREATE TABLE IF NOT EXISTS multiplayer_games (
                 game_id TEXT PRIMARY KEY,
@@ -442,8 +763,13 @@ async def init_db():
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user_id ON purchases(user_id)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_status ON purchases(status)")
+        # Частичный индекс: в нём только ожидающие заявки, список для админа читается упорядоченно без сортировки
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_pending ON purchases(purchase_date, id) WHERE status='pending'")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_giveaways_status ON giveaways(status)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_giveaways_status_end ON giveaways(status, end_date)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_participants_gid ON participants(giveaway_id)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_promo_activations_user ON promo_activations(user_id)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_promocodes_code_md5 ON promocodes (left(md5(code), 16))")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_tasks_expires ON user_tasks(expires_at)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_active ON tasks(active)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id)")
@@ -451,64 +777,113 @@ async def init_db():
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_level ON users(level)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_exp ON users(exp)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_bosses_chat_status ON bosses(chat_id, status)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_bosses_active_expires ON bosses(expires_at) WHERE status='active'")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_boss_attacks_boss ON boss_attacks(boss_id)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_confirmed_chats_chat ON confirmed_chats(chat_id)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_requests_status ON chat_confirmation_requests(status)")
 
-    # Заполняем настройки
+    # Заполняем настройки и сразу загружаем их в кэш
     await init_settings()
-    # Заполняем level_rewards
+    await load_settings()
+    # Заполняем level_rewards одним пакетом; уже существующие уровни не трогаем
+    rewards = []
+    for lvl in range(1, 101):
+        coins = int(DEFAULT_SETTINGS["level_reward_coins"]) + (lvl-1) * int(DEFAULT_SETTINGS["level_reward_coins_increment"])
+        rep = int(DEFAULT_SETTINGS["level_reward_reputation"]) + (lvl-1) * int(DEFAULT_SETTINGS["level_reward_reputation_increment"])
+        rewards.append((lvl, coins, rep))
     async with db_pool.acquire() as conn:
-        for lvl in range(1, 101):
-            exists = await conn.fetchval("SELECT level FROM level_rewards WHERE level=$1", lvl)
-            if not exists:
-                coins = int(DEFAULT_SETTINGS["level_reward_coins"]) + (lvl-1) * int(DEFAULT_SETTINGS["level_reward_coins_increment"])
-                rep = int(DEFAULT_SETTINGS["level_reward_reputation"]) + (lvl-1) * int(DEFAULT_SETTINGS["level_reward_reputation_increment"])
-                await conn.execute(
-                    "INSERT INTO level_rewards (level, coins, reputation) VALUES ($1, $2, $3)",
-                    lvl, coins, rep
-                )
+        await conn.executemany(
+            "INSERT INTO level_rewards (level, coins, reputation) VALUES ($1, $2, $3) ON CONFLICT (level) DO NOTHING",
+            rewards
+        )
     logging.info("Таблицы в PostgreSQL проверены/обновлены")
 
+async def migrate_column_to_timestamp(conn, table: str, column: str, default: str = None):
+    data_type = await conn.fetchval(
+        "SELECT data_type FROM information_schema.columns WHERE table_name=$1 AND column_name=$2",
+        table, column
+    )
+    if data_type == 'text':
+        await conn.execute(
+            f"ALTER TABLE {table} ALTER COLUMN {column} TYPE TIMESTAMP USING NULLIF({column}, '')::timestamp"
+        )
+        if default:
+            await conn.execute(f"ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT {default}")
+
 async def init_settings():
     async with db_pool.acquire() as conn:
-        for key, value in DEFAULT_SETTINGS.items():
-            await conn.execute(
-                "INSERT INTO settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO NOTHING",
-                key, value
-            )
+        await conn.executemany(
+            "INSERT INTO settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO NOTHING",
+            DEFAULT_SETTINGS.items()
+        )
 
-async def get_setting(key: str) -> str:
+async def load_settings():
     global settings_cache, last_settings_update
-    now = time.time()
-    if now - last_settings_update > 60 or not settings_cache:
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch("SELECT key, value FROM settings")
-            settings_cache = {row['key']: row['value'] for row in rows}
-        last_settings_update = now
-    return settings_cache.get(key, DEFAULT_SETTINGS[key])
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT key, value FROM settings")
+    settings_cache = {row['key']: row['value'] for row in rows}
+    last_settings_update = time.time()
+
+async def get_settings() -> dict:
+    # Кэш заполняется при старте и обновляется set_setting; периодическая
+    # перезагрузка подхватывает изменения, сделанные другим экземпляром бота
+    if time.time() - last_settings_update > 60 or not settings_cache:
+        async with settings_lock:
+            if time.time() - last_settings_update > 60 or not settings_cache:
+                await load_settings()
+    return settings_cache
+
+async def get_setting(key: str) -> str:
+    settings = await get_settings()
+    return settings.get(key, DEFAULT_SETTINGS[key])
 
 async def set_setting(key: str, value: str):
     async with db_pool.acquire() as conn:
         await conn.execute("UPDATE settings SET value=$1 WHERE key=$2", value, key)
     settings_cache[key] = value
+    if key.startswith("boss_"):
+        boss_spawn_wakeup.set()
 
 # ===== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =====
 async def is_super_admin(user_id: int) -> bool:
     return user_id in SUPER_ADMINS
 
 async def is_junior_admin(user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchval("SELECT user_id FROM admins WHERE user_id=$1", user_id)
-    return row is not None
+    # is_admin проверяется почти на каждое сообщение (в т.ч. в мидлвари), а админов
+    # единицы: держим весь набор в памяти, добавление/удаление админа обновляет его сразу
+    global admin_ids_cache, last_admins_update
+    if admin_ids_cache is None or time.time() - last_admins_update > 60:
+        async with admin_ids_lock:
+            if admin_ids_cache is None or time.time() - last_admins_update > 60:
+                async with db_pool.acquire() as conn:
+                    rows = await conn.fetch("SELECT user_id FROM admins")
+                admin_ids_cache = {r['user_id'] for r in rows}
+                last_admins_update = time.time()
+    return user_id in admin_ids_cache
 
 async def is_admin(user_id: int) -> bool:
     return await is_super_admin(user_id) or await is_junior_admin(user_id)
 
 async def is_banned(user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchval("SELECT user_id FROM banned_users WHERE user_id=$1", user_id)
-    return row is not None
+    # Блокировок мало и меняются они редко: держим все id в памяти,
+    # хендлеры блокировки/разблокировки обновляют набор сами
+    global banned_ids_cache, last_banned_update
+    if banned_ids_cache is None or time.time() - last_banned_update > 60:
+        async with banned_ids_lock:
+            if banned_ids_cache is None or time.time() - last_banned_update > 60:
+                async with db_pool.acquire() as conn:
+                    rows = await conn.fetch("SELECT user_id FROM banned_users")
+                banned_ids_cache = {r['user_id'] for r in rows}
+                last_banned_update = time.time()
+    return user_id in banned_ids_cache
+
+def parse_int(text: str):
+    # Дешёвая проверка isdigit() вместо try/except вокруг int(); None, если не число
+    t = (text or "").strip()
+    digits = t[1:] if t.startswith('-') else t
+    if not (digits.isascii() and digits.isdigit()):
+        return None
+    return int(t, 10)
 
 async def get_channels():
     global channels_cache, last_channels_update
@@ -530,6 +905,18 @@ async def get_confirmed_chats(force_update=False) -> Dict[int, dict]:
         last_confirmed_chats_update = now
     return confirmed_chats_cache
 
+async def get_active_tasks(force_update=False) -> Dict[int, dict]:
+    # Задания меняет только суперадмин, а читают их при каждом открытии меню и нажатии «Выполнить»
+    global active_tasks_cache, last_tasks_update
+    if force_update or active_tasks_cache is None or time.time() - last_tasks_update > 300:
+        async with active_tasks_lock:
+            if force_update or active_tasks_cache is None or time.time() - last_tasks_update > 300:
+                async with db_pool.acquire() as conn:
+                    rows = await conn.fetch("SELECT * FROM tasks WHERE active=TRUE ORDER BY id")
+                active_tasks_cache = {row['id']: dict(row) for row in rows}
+                last_tasks_update = time.time()
+    return active_tasks_cache
+
 async def is_chat_confirmed(chat_id: int) -> bool:
     confirmed = await get_confirmed_chats()
     return chat_id in confirmed
@@ -541,6 +928,7 @@ async def add_confirmed_chat(chat_id: int, title: str, chat_type: str, confirmed
             chat_id, title, chat_type, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), confirmed_by, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         )
     await get_confirmed_chats(force_update=True)
+    boss_spawn_wakeup.set()
 
 async def remove_confirmed_chat(chat_id: int):
     async with db_pool.acquire() as conn:
@@ -703,7 +1091,7 @@ async def notify_chats(message_text: str, importance: str = 'info'):
     for chat_id, data in confirmed.items():
         if not data.get('notify_enabled', True):
             continue
-        await safe_send_chat(chat_id, message_text)
+        safe_send_chat_task(chat_id, message_text)
 
 # Функции для мультиплеера
 def generate_game_id():
@@ -877,7 +1265,7 @@ def subscription_inline(not_subscribed):
     kb.append([InlineKeyboardButton(text="✅ Я подписался", callback_data="check_sub")])
     return InlineKeyboardMarkup(row_width=1, inline_keyboard=kb)
 
-def user_main_keyboard(is_admin_user=False):
+def build_user_main_keyboard(is_admin_user=False):
     buttons = [
         [KeyboardButton(text="👤 Профиль"), KeyboardButton(text="🎁 Бонус")],
         [KeyboardButton(text="🛒 Магазин подарков"), KeyboardButton(text="🎰 Казино")],
@@ -1099,11 +1487,28 @@ def settings_reply_keyboard():
 def back_keyboard():
     return ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="◀️ Назад")]], resize_keyboard=True)
 
-def purchase_action_keyboard(purchase_id):
-    return InlineKeyboardMarkup(row_width=2, inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Выполнено", callback_data=f"purchase_done_{purchase_id}"),
-         InlineKeyboardButton(text="❌ Отказ", callback_data=f"purchase_reject_{purchase_id}")]
-    ])
+# Статичные клавиатуры собираются один раз при загрузке модуля
+ADMIN_SHOP_KB = admin_shop_keyboard()
+ADMIN_GIVEAWAY_KB = admin_giveaway_keyboard()
+ADMIN_CHANNEL_KB = admin_channel_keyboard()
+ADMIN_PROMO_KB = admin_promo_keyboard()
+ADMIN_TASKS_KB = admin_tasks_keyboard()
+BACK_KB = back_keyboard()
+USER_MAIN_KB = build_user_main_keyboard(False)
+USER_MAIN_ADMIN_KB = build_user_main_keyboard(True)
+
+def user_main_keyboard(is_admin_user=False):
+    # Главное меню отправляется почти в каждом ответе — отдаём готовую клавиатуру
+    return USER_MAIN_ADMIN_KB if is_admin_user else USER_MAIN_KB
+
+# Фабрики callback_data: aiogram сам проверяет префикс и разбирает поля
+purchase_cb = CallbackData("purchase", "action", "pid")
+purchases_page_cb = CallbackData("purchases", "direction", "pid")
+promos_page_cb = CallbackData("promos", "direction", "code")
+
+def purchase_action_row(purchase_id):
+    return [InlineKeyboardButton(text=f"✅ #{purchase_id}", callback_data=purchase_cb.new(action="done", pid=purchase_id)),
+            InlineKeyboardButton(text=f"❌ #{purchase_id}", callback_data=purchase_cb.new(action="reject", pid=purchase_id))]
 
 def confirm_chat_inline(chat_id: int):
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -1321,7 +1726,7 @@ async def cmd_start(message: types.Message):
                             "INSERT INTO referrals (referrer_id, referred_id, referred_date, reward_given) VALUES ($1, $2, $3, $4)",
                             referrer_id, user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), False
                         )
-                        await safe_send_message(referrer_id, f"🔗 Новый пользователь {message.from_user.first_name} зарегистрировался по вашей ссылке! Награда будет выдана после того, как он совершит 15 успешных ограблений.")
+                        safe_send_message_task(referrer_id, f"🔗 Новый пользователь {message.from_user.first_name} зарегистрировался по вашей ссылке! Награда будет выдана после того, как он совершит 15 успешных ограблений.")
         except:
             pass
 
@@ -1741,7 +2146,7 @@ async def shop_handler(message: types.Message):
 
 @dp.callback_query_handler(lambda c: c.data.startswith("shop_page_"))
 async def shop_page_callback(callback: types.CallbackQuery):
-    page = int(callback.data.split("_")[2])
+    page = int(callback.data.removeprefix("shop_page_"))
     callback.message.text = f"🛒 Магазин подарков {page}"
     await shop_handler(callback.message)
     await callback.answer()
@@ -1756,7 +2161,7 @@ async def buy_callback(callback: types.CallbackQuery):
     if not ok:
         await callback.message.edit_text("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
-    item_id = int(callback.data.split("_")[1])
+    item_id = int(callback.data.removeprefix("buy_"))
     try:
         async with db_pool.acquire() as conn:
             row = await conn.fetchrow("SELECT name, price, stock FROM shop_items WHERE id=$1", item_id)
@@ -1873,7 +2278,7 @@ async def my_purchases(message: types.Message):
 
 @dp.callback_query_handler(lambda c: c.data.startswith("mypurchases_page_"))
 async def mypurchases_page_callback(callback: types.CallbackQuery):
-    page = int(callback.data.split("_")[2])
+    page = int(callback.data.removeprefix("mypurchases_page_"))
     callback.message.text = f"💰 Мои покупки {page}"
     await my_purchases(callback.message)
     await callback.answer()
@@ -1890,7 +2295,7 @@ async def casino_handler(message: types.Message):
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
-    await message.answer("🎰 Введи сумму ставки (целое число):", reply_markup=back_keyboard())
+    await message.answer("🎰 Введи сумму ставки (целое число):", reply_markup=BACK_KB)
     await CasinoBet.amount.set()
 
 @dp.message_handler(state=CasinoBet.amount)
@@ -1984,7 +2389,7 @@ async def dice_game(message: types.Message):
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
-    await message.answer("🎲 Введи сумму ставки (целое число):", reply_markup=back_keyboard())
+    await message.answer("🎲 Введи сумму ставки (целое число):", reply_markup=BACK_KB)
     await DiceBet.amount.set()
 
 @dp.message_handler(state=DiceBet.amount)
@@ -2045,7 +2450,7 @@ async def guess_game(message: types.Message):
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
-    await message.answer("🔢 Введи сумму ставки (целое число):", reply_markup=back_keyboard())
+    await message.answer("🔢 Введи сумму ставки (целое число):", reply_markup=BACK_KB)
     await GuessBet.amount.set()
 
 @dp.message_handler(state=GuessBet.amount)
@@ -2072,7 +2477,7 @@ async def guess_bet_amount(message: types.Message, state: FSMContext):
         await state.finish()
         return
     await state.update_data(amount=amount)
-    await message.answer("🔢 Загадай число от 1 до 5:", reply_markup=back_keyboard())
+    await message.answer("🔢 Загадай число от 1 до 5:", reply_markup=BACK_KB)
     await GuessBet.number.set()
 
 @dp.message_handler(state=GuessBet.number)
@@ -2135,7 +2540,7 @@ async def promo_handler(message: types.Message):
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
-    await message.answer("Введи промокод:", reply_markup=back_keyboard())
+    await message.answer("Введи промокод:", reply_markup=BACK_KB)
     await PromoActivate.code.set()
 
 @dp.message_handler(state=PromoActivate.code)
@@ -2214,7 +2619,9 @@ async def giveaways_handler(message: types.Message):
         async with db_pool.acquire() as conn:
             total = await conn.fetchval("SELECT COUNT(*) FROM giveaways WHERE status='active'")
             rows = await conn.fetch(
-                "SELECT id, prize, end_date FROM giveaways WHERE status='active' ORDER BY end_date LIMIT $1 OFFSET $2",
+                "SELECT g.id, g.prize, g.end_date, COUNT(p.user_id) AS participants_count "
+                "FROM giveaways g LEFT JOIN participants p ON p.giveaway_id = g.id "
+                "WHERE g.status='active' GROUP BY g.id ORDER BY g.end_date LIMIT $1 OFFSET $2",
                 ITEMS_PER_PAGE, offset
             )
         if not rows:
@@ -2226,9 +2633,7 @@ async def giveaways_handler(message: types.Message):
         text = f"🎁 Активные розыгрыши (страница {page}):\n\n"
         kb = []
         for row in rows:
-            gid, prize, end = row['id'], row['prize'], row['end_date']
-            async with db_pool.acquire() as conn2:
-                count = await conn2.fetchval("SELECT COUNT(*) FROM participants WHERE giveaway_id=$1", gid)
+            gid, prize, end, count = row['id'], row['prize'], row['end_date'], row['participants_count']
             text += f"ID: {gid} | {prize} | до {end} | 👥 {count} участников\n"
             kb.append([InlineKeyboardButton(text=f"🔍 Подробнее о {prize}", callback_data=f"detail_{gid}")])
         nav_buttons = []
@@ -2246,7 +2651,7 @@ async def giveaways_handler(message: types.Message):
 
 @dp.callback_query_handler(lambda c: c.data.startswith("giveaways_page_"))
 async def giveaways_page_callback(callback: types.CallbackQuery):
-    page = int(callback.data.split("_")[2])
+    page = int(callback.data.removeprefix("giveaways_page_"))
     callback.message.text = f"🎲 Розыгрыши {page}"
     await giveaways_handler(callback.message)
     await callback.answer()
@@ -2256,7 +2661,7 @@ async def giveaway_detail(callback: types.CallbackQuery):
     if await is_banned(callback.from_user.id) and not await is_admin(callback.from_user.id):
         await callback.answer("⛔ Вы заблокированы.", show_alert=True)
         return
-    giveaway_id = int(callback.data.split("_")[1])
+    giveaway_id = int(callback.data.removeprefix("detail_"))
     try:
         async with db_pool.acquire() as conn:
             row = await conn.fetchrow(
@@ -2292,7 +2697,7 @@ async def confirm_participation(callback: types.CallbackQuery):
     if await is_banned(callback.from_user.id) and not await is_admin(callback.from_user.id):
         await callback.answer("⛔ Вы заблокированы.", show_alert=True)
         return
-    giveaway_id = int(callback.data.split("_")[2])
+    giveaway_id = int(callback.data.removeprefix("confirm_part_"))
     user_id = callback.from_user.id
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
@@ -2304,7 +2709,12 @@ async def confirm_participation(callback: types.CallbackQuery):
             if not status or status != 'active':
                 await callback.answer("Розыгрыш не активен", show_alert=True)
                 return
-            await conn.execute("INSERT INTO participants (user_id, giveaway_id) VALUES ($1, $2) ON CONFLICT DO NOTHING", user_id, giveaway_id)
+        # После анонса участники жмут кнопку одновременно — вставки уходят общим пакетом.
+        # Соединение к этому моменту уже возвращено в пул, иначе всплеск занял бы его целиком
+        await insert_coalescer.enqueue(
+            "participants", ("user_id", "giveaway_id"), (user_id, giveaway_id),
+            conflict=("user_id", "giveaway_id")
+        )
         await callback.answer("✅ Ты участвуешь в розыгрыше!", show_alert=True)
         await giveaways_handler(callback.message)
     except Exception as e:
@@ -2398,7 +2808,7 @@ async def theft_choose_user(message: types.Message, state: FSMContext):
                 phrase = random.choice(THEFT_COOLDOWN_PHRASES).format(minutes=remaining)
                 await message.answer(phrase, reply_markup=user_main_keyboard(await is_admin(user_id)))
                 return
-    await message.answer("Введи @username или ID того, кого хочешь ограбить:", reply_markup=back_keyboard())
+    await message.answer("Введи @username или ID того, кого хочешь ограбить:", reply_markup=BACK_KB)
     await TheftTarget.target.set()
 
 @dp.message_handler(state=TheftTarget.target)
@@ -2479,7 +2889,7 @@ async def perform_theft(message: types.Message, robber_id: int, victim_id: int):
                 robber_phrase = random.choice(THEFT_DEFENSE_PHRASES).format(target=victim_name, penalty=penalty)
                 victim_phrase = random.choice(THEFT_VICTIM_DEFENSE_PHRASES).format(attacker=message.from_user.first_name, penalty=penalty)
                 await message.answer(robber_phrase, reply_markup=user_main_keyboard(await is_admin(robber_id)))
-                await safe_send_message(victim_id, victim_phrase)
+                safe_send_message_task(victim_id, victim_phrase)
                 return
 
             success = random.randint(1, 100) <= success_chance
@@ -2507,11 +2917,11 @@ async def perform_theft(message: types.Message, robber_id: int, victim_id: int):
                         await update_user_balance(referrer_id, bonus_coins)
                         await update_user_reputation(referrer_id, bonus_rep)
                         await conn.execute("UPDATE referrals SET reward_given=TRUE WHERE referred_id=$1", robber_id)
-                        await safe_send_message(referrer_id, f"🎉 Ваш реферал совершил 15 успешных ограблений! Вы получили {bonus_coins} монет и {bonus_rep} репутации.")
+                        safe_send_message_task(referrer_id, f"🎉 Ваш реферал совершил 15 успешных ограблений! Вы получили {bonus_coins} монет и {bonus_rep} репутации.")
 
                 phrase = random.choice(THEFT_SUCCESS_PHRASES).format(amount=steal_amount, target=victim_name)
                 await message.answer(phrase, reply_markup=user_main_keyboard(await is_admin(robber_id)))
-                await safe_send_message(victim_id, f"🔫 Вас ограбили! {message.from_user.first_name} украл {steal_amount} монет.")
+                safe_send_message_task(victim_id, f"🔫 Вас ограбили! {message.from_user.first_name} украл {steal_amount} монет.")
             else:
                 await conn.execute("UPDATE users SET theft_attempts = theft_attempts + 1, theft_failed = theft_failed + 1 WHERE user_id=$1", robber_id)
                 exp_fail = int(await get_setting("exp_per_theft_fail"))
@@ -2553,8 +2963,7 @@ async def tasks_menu(message: types.Message):
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
 
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT id, name, description, reward_coins, reward_reputation FROM tasks WHERE active=TRUE")
+    rows = list((await get_active_tasks()).values())
     if not rows:
         await message.answer("📋 Пока нет доступных заданий.", reply_markup=user_main_keyboard(await is_admin(user_id)))
         return
@@ -2568,45 +2977,61 @@ async def tasks_menu(message: types.Message):
 
 @dp.callback_query_handler(lambda c: c.data.startswith("task_"))
 async def take_task(callback: types.CallbackQuery):
-    task_id = int(callback.data.split("_")[1])
+    task_id = int(callback.data.removeprefix("task_"))
     user_id = callback.from_user.id
 
     async with db_pool.acquire() as conn:
         existing = await conn.fetchval("SELECT 1 FROM user_tasks WHERE user_id=$1 AND task_id=$2", user_id, task_id)
-        if existing:
-            await callback.answer("Ты уже выполнял это задание!", show_alert=True)
-            return
+    task = (await get_active_tasks()).get(task_id)
+    if existing:
+        await callback.answer("Ты уже выполнял это задание!", show_alert=True)
+        return
+    if not task:
+        await callback.answer("Задание не найдено или неактивно.", show_alert=True)
+        return
+    if task['task_type'] != 'subscribe':
+        await callback.answer("Этот тип заданий пока не поддерживается.", show_alert=True)
+        return
 
-        task = await conn.fetchrow("SELECT * FROM tasks WHERE id=$1 AND active=TRUE", task_id)
-        if not task:
-            await callback.answer("Задание не найдено или неактивно.", show_alert=True)
+    # Проверка подписки идёт в Telegram и может занять секунды — соединение из пула на это время не держим
+    channel_id = task['target_id']
+    try:
+        member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
+        if member.status in ['left', 'kicked']:
+            await callback.answer("❌ Ты не подписан на этот канал!", show_alert=True)
             return
+    except Exception as e:
+        logging.error(f"Task subscribe check error: {e}")
+        await callback.answer("❌ Не удалось проверить подписку. Возможно, бот не админ канала.", show_alert=True)
+        return
 
-        if task['task_type'] == 'subscribe':
-            channel_id = task['target_id']
-            try:
-                member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-                if member.status in ['left', 'kicked']:
-                    await callback.answer("❌ Ты не подписан на этот канал!", show_alert=True)
-                    return
-            except Exception as e:
-                logging.error(f"Task subscribe check error: {e}")
-                await callback.answer("❌ Не удалось проверить подписку. Возможно, бот не админ канала.", show_alert=True)
-                return
-
-            async with conn.transaction():
+    # Пока шла проверка подписки, повторное нажатие могло уже засчитать задание, а админ —
+    # отключить его (кэш заданий на других экземплярах отстаёт до 5 минут): награда начисляется,
+    # только если задание активно в БД и запись о выполнении действительно вставлена
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            expires_at = datetime.now() + timedelta(days=task['required_days']) if task['required_days'] > 0 else None
+            inserted = await conn.fetchval(
+                "INSERT INTO user_tasks (user_id, task_id, completed_at, expires_at, status) "
+                "SELECT $1, id, $3, $4, 'completed' FROM tasks WHERE id=$2 AND active=TRUE "
+                "ON CONFLICT (user_id, task_id) DO NOTHING RETURNING task_id",
+                user_id, task_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), expires_at
+            )
+            if inserted is not None:
                 await conn.execute("UPDATE users SET balance = balance + $1, reputation = reputation + $2 WHERE user_id=$3",
                                    task['reward_coins'], task['reward_reputation'], user_id)
-                expires_at = (datetime.now() + timedelta(days=task['required_days'])).strftime("%Y-%m-%d %H:%M:%S") if task['required_days'] > 0 else None
-                await conn.execute(
-                    "INSERT INTO user_tasks (user_id, task_id, completed_at, expires_at, status) VALUES ($1, $2, $3, $4, $5)",
-                    user_id, task_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), expires_at, 'completed'
-                )
-
-            await callback.answer(f"✅ Задание выполнено! +{task['reward_coins']} монет, +{task['reward_reputation']} репутации", show_alert=True)
-            await callback.message.delete()
+            else:
+                still_active = await conn.fetchval("SELECT active FROM tasks WHERE id=$1", task_id)
+    if inserted is None:
+        if still_active:
+            await callback.answer("Ты уже выполнял это задание!", show_alert=True)
         else:
-            await callback.answer("Этот тип заданий пока не поддерживается.", show_alert=True)
+            await get_active_tasks(force_update=True)
+            await callback.answer("Задание не найдено или неактивно.", show_alert=True)
+        return
+
+    await callback.answer(f"✅ Задание выполнено! +{task['reward_coins']} монет, +{task['reward_reputation']} репутации", show_alert=True)
+    await callback.message.delete()
 
 # ===== МУЛЬТИПЛЕЕРНАЯ ИГРА "21" (полная) =====
 @dp.message_handler(lambda message: message.text == "👥 Комнатная игра 21")
@@ -2705,7 +3130,7 @@ async def join_room_callback(callback: types.CallbackQuery):
         )
         host_id = game['host_id']
         if host_id != user_id:
-            await safe_send_message(host_id, f"✅ @{username} присоединился к твоей комнате `{game_id}`.")
+            safe_send_message_task(host_id, f"✅ @{username} присоединился к твоей комнате `{game_id}`.")
     await callback.message.edit_text(f"✅ Ты присоединился к комнате `{game_id}`. Ожидаем остальных...")
     await callback.message.answer("Ты в комнате. Можешь выйти в любой момент до начала игры.", reply_markup=leave_room_keyboard(game_id))
     await callback.answer()
@@ -2717,7 +3142,7 @@ async def create_room_start(message: types.Message):
     if count >= MAX_ROOMS:
         await message.answer(f"❌ Достигнут лимит активных комнат ({MAX_ROOMS}). Попробуй позже.")
         return
-    await message.answer("Введи количество игроков (2–5):", reply_markup=back_keyboard())
+    await message.answer("Введи количество игроков (2–5):", reply_markup=BACK_KB)
     await MultiplayerGame.create_max_players.set()
 
 @dp.message_handler(state=MultiplayerGame.create_max_players)
@@ -2813,7 +3238,7 @@ async def leave_room_callback(callback: types.CallbackQuery):
                 next_host = await conn.fetchval("SELECT user_id FROM game_players WHERE game_id=$1 ORDER BY joined_at LIMIT 1", game_id)
                 if next_host:
                     await conn.execute("UPDATE multiplayer_games SET host_id=$1 WHERE game_id=$2", next_host, game_id)
-                    await safe_send_message(next_host, f"🎮 Ты стал создателем комнаты `{game_id}`.")
+                    safe_send_message_task(next_host, f"🎮 Ты стал создателем комнаты `{game_id}`.")
                 else:
                     await conn.execute("DELETE FROM multiplayer_games WHERE game_id=$1", game_id)
             await callback.message.edit_text("❌ Ты покинул комнату.")
@@ -2848,14 +3273,14 @@ async def start_game_callback(callback: types.CallbackQuery):
             return
         await conn.execute("UPDATE multiplayer_games SET status='playing' WHERE game_id=$1", game_id)
         deck = create_deck()
+        hands = []
         for player in players:
             cards = [deck.pop(), deck.pop()]
-            cards_str = ','.join(cards)
-            value = calculate_hand_value(cards)
-            await conn.execute(
-                "UPDATE game_players SET cards=$1, value=$2 WHERE game_id=$3 AND user_id=$4",
-                cards_str, value, game_id, player['user_id']
-            )
+            hands.append((','.join(cards), calculate_hand_value(cards), game_id, player['user_id']))
+        await conn.executemany(
+            "UPDATE game_players SET cards=$1, value=$2 WHERE game_id=$3 AND user_id=$4",
+            hands
+        )
         await conn.execute(
             "INSERT INTO game_players (game_id, user_id, username, cards, value, stopped, joined_at, doubled) VALUES ($1, $2, $3, $4, $5, $6, $7, $8)",
             game_id, 0, 'Дилер', '', 0, False, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), False
@@ -2896,7 +3321,7 @@ async def process_next_turn(game_id: str, player_index: int):
         kb_buttons.append(row2)
         kb_buttons.append([InlineKeyboardButton(text="💬 Написать в чат", callback_data="room_chat")])
         kb = InlineKeyboardMarkup(inline_keyboard=kb_buttons)
-        await safe_send_message(
+        safe_send_message_task(
             current_player['user_id'],
             f"🎮 Твой ход!\nТвои карты: {', '.join(cards)} (очков: {value})\n\nВыбери действие:",
             reply_markup=kb
@@ -3049,7 +3474,7 @@ async def room_chat_message(message: types.Message, state: FSMContext):
         players = await conn.fetch("SELECT user_id FROM game_players WHERE game_id=$1 AND user_id != 0", game_id)
         for player in players:
             if player['user_id'] != user_id:
-                await safe_send_message(player['user_id'], f"💬 {message.from_user.first_name}: {message.text}")
+                safe_send_message_task(player['user_id'], f"💬 {message.from_user.first_name}: {message.text}")
     await state.finish()
     await message.answer("✅ Сообщение отправлено всем игрокам в комнате.")
 
@@ -3110,7 +3535,7 @@ async def dealer_turn(game_id: str):
                 results.append((player['user_id'], f"🤝 Ничья (возврат ставки)", 0))
         dealer_cards_str = ', '.join(dealer_cards) if dealer_cards else 'нет карт'
         for user_id, res, _ in results:
-            await safe_send_message(user_id,
+            safe_send_message_task(user_id,
                 f"🎮 Итоги игры в комнате `{game_id}`:\n"
                 f"Карты дилера: {dealer_cards_str} (очков: {dealer_value})\n"
                 f"Результат: {res}"
@@ -3146,7 +3571,7 @@ async def confirm_chat_callback(callback: types.CallbackQuery):
     if not await is_super_admin(callback.from_user.id):
         await callback.answer("❌ Недостаточно прав", show_alert=True)
         return
-    chat_id = int(callback.data.split("_")[2])
+    chat_id = int(callback.data.removeprefix("confirm_chat_"))
     async with db_pool.acquire() as conn:
         request = await conn.fetchrow("SELECT * FROM chat_confirmation_requests WHERE chat_id=$1", chat_id)
         if not request:
@@ -3163,7 +3588,7 @@ async def reject_chat_callback(callback: types.CallbackQuery):
     if not await is_super_admin(callback.from_user.id):
         await callback.answer("❌ Недостаточно прав", show_alert=True)
         return
-    chat_id = int(callback.data.split("_")[2])
+    chat_id = int(callback.data.removeprefix("reject_chat_"))
     async with db_pool.acquire() as conn:
         request = await conn.fetchrow("SELECT * FROM chat_confirmation_requests WHERE chat_id=$1", chat_id)
         if not request:
@@ -3282,13 +3707,13 @@ async def spawn_boss(chat_id: int, level: int = None):
         boss_id = await conn.fetchval(
             "INSERT INTO bosses (chat_id, name, level, hp, max_hp, spawned_at, expires_at, reward_coins, participants, status) "
             "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10) RETURNING id",
-            chat_id, name, level, hp, hp, now.strftime("%Y-%m-%d %H:%M:%S"),
-            expires_at.strftime("%Y-%m-%d %H:%M:%S"), reward, [], 'active'
+            chat_id, name, level, hp, hp, now, expires_at, reward, [], 'active'
         )
         await conn.execute(
             "UPDATE confirmed_chats SET boss_last_spawn=$1, boss_spawn_count = boss_spawn_count + 1 WHERE chat_id=$2",
             now.strftime("%Y-%m-%d %H:%M:%S"), chat_id
         )
+    boss_expiry_wakeup.set()
     phrase = random.choice(BOSS_SPAWN_PHRASES).format(name=name, level=level, hp=hp)
     await safe_send_chat(chat_id, phrase, reply_markup=boss_attack_keyboard())
 
@@ -3305,7 +3730,7 @@ async def boss_attack_callback(callback: types.CallbackQuery):
     async with db_pool.acquire() as conn:
         boss = await conn.fetchrow(
             "SELECT * FROM bosses WHERE chat_id=$1 AND status='active' AND expires_at > $2 ORDER BY spawned_at DESC LIMIT 1",
-            chat_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            chat_id, datetime.now()
         )
         if not boss:
             await callback.answer("❌ В этом чате сейчас нет активного босса.", show_alert=True)
@@ -3319,7 +3744,7 @@ async def boss_attack_callback(callback: types.CallbackQuery):
         attack = await conn.fetchrow("SELECT * FROM boss_attacks WHERE boss_id=$1 AND user_id=$2", boss['id'], user_id)
         if attack:
             cooldown = int(await get_setting("boss_attack_cooldown"))
-            last_attack = datetime.strptime(attack['attack_time'], "%Y-%m-%d %H:%M:%S")
+            last_attack = attack['attack_time']
             if datetime.now() - last_attack < timedelta(minutes=cooldown):
                 remaining = cooldown - int((datetime.now() - last_attack).total_seconds() // 60)
                 await callback.answer(f"⏳ Ты сможешь атаковать снова через {remaining} мин.", show_alert=True)
@@ -3355,12 +3780,12 @@ async def boss_attack_callback(callback: types.CallbackQuery):
         if attack:
             await conn.execute(
                 "UPDATE boss_attacks SET damage=$1, attack_time=$2 WHERE boss_id=$3 AND user_id=$4",
-                damage, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), boss['id'], user_id
+                damage, datetime.now(), boss['id'], user_id
             )
         else:
             await conn.execute(
                 "INSERT INTO boss_attacks (boss_id, user_id, damage, attack_time) VALUES ($1, $2, $3, $4)",
-                boss['id'], user_id, damage, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                boss['id'], user_id, damage, datetime.now()
             )
 
         effect_text = ""
@@ -3412,7 +3837,7 @@ async def finish_boss_fight(boss_id: int):
             await add_exp(uid, exp)
         await conn.execute("UPDATE bosses SET status='defeated' WHERE id=$1", boss_id)
         phrase = random.choice(BOSS_DEATH_PHRASES).format(name=boss['name'])
-        await safe_send_chat(boss['chat_id'], f"{phrase}\nУчастники получили по {reward_per_player} монет!")
+        safe_send_chat_task(boss['chat_id'], f"{phrase}\nУчастники получили по {reward_per_player} монет!")
 
 # ===== НАЗАД В ГЛАВНОЕ МЕНЮ =====
 @dp.message_handler(lambda message: message.text == "◀️ Назад в главное меню")
@@ -3467,7 +3892,7 @@ async def add_balance_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может начислять монеты.")
         return
-    await message.answer("Введи ID или @username пользователя:", reply_markup=back_keyboard())
+    await message.answer("Введи ID или @username пользователя:", reply_markup=BACK_KB)
     await AddBalance.user_id.set()
 
 @dp.message_handler(state=AddBalance.user_id)
@@ -3503,7 +3928,7 @@ async def add_balance_amount(message: types.Message, state: FSMContext):
     try:
         await update_user_balance(uid, amount)
         await message.answer(f"✅ Пользователю {uid} начислено {amount} монет.")
-        await safe_send_message(uid, f"💰 Вам начислено {amount} монет администратором.")
+        safe_send_message_task(uid, f"💰 Вам начислено {amount} монет администратором.")
     except Exception as e:
         logging.error(f"Add balance error: {e}")
         await message.answer("❌ Ошибка.")
@@ -3514,7 +3939,7 @@ async def remove_balance_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может списывать монеты.")
         return
-    await message.answer("Введи ID или @username пользователя:", reply_markup=back_keyboard())
+    await message.answer("Введи ID или @username пользователя:", reply_markup=BACK_KB)
     await RemoveBalance.user_id.set()
 
 @dp.message_handler(state=RemoveBalance.user_id)
@@ -3550,7 +3975,7 @@ async def remove_balance_amount(message: types.Message, state: FSMContext):
     try:
         await update_user_balance(uid, -amount)
         await message.answer(f"✅ У пользователя {uid} списано {amount} монет.")
-        await safe_send_message(uid, f"💸 У тебя списано {amount} монет администратором.")
+        safe_send_message_task(uid, f"💸 У тебя списано {amount} монет администратором.")
     except Exception as e:
         logging.error(f"Remove balance error: {e}")
         await message.answer("❌ Ошибка.")
@@ -3561,7 +3986,7 @@ async def add_reputation_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может начислять репутацию.")
         return
-    await message.answer("Введи ID или @username пользователя:", reply_markup=back_keyboard())
+    await message.answer("Введи ID или @username пользователя:", reply_markup=BACK_KB)
     await AddReputation.user_id.set()
 
 @dp.message_handler(state=AddReputation.user_id)
@@ -3595,7 +4020,7 @@ async def add_reputation_amount(message: types.Message, state: FSMContext):
     try:
         await update_user_reputation(uid, amount)
         await message.answer(f"✅ Пользователю {uid} начислено {amount} репутации.")
-        await safe_send_message(uid, f"⭐️ Вам начислено {amount} репутации администратором.")
+        safe_send_message_task(uid, f"⭐️ Вам начислено {amount} репутации администратором.")
     except Exception as e:
         logging.error(f"Add reputation error: {e}")
         await message.answer("❌ Ошибка.")
@@ -3606,7 +4031,7 @@ async def remove_reputation_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может снимать репутацию.")
         return
-    await message.answer("Введи ID или @username пользователя:", reply_markup=back_keyboard())
+    await message.answer("Введи ID или @username пользователя:", reply_markup=BACK_KB)
     await RemoveReputation.user_id.set()
 
 @dp.message_handler(state=RemoveReputation.user_id)
@@ -3640,7 +4065,7 @@ async def remove_reputation_amount(message: types.Message, state: FSMContext):
     try:
         await update_user_reputation(uid, -amount)
         await message.answer(f"✅ У пользователя {uid} снято {amount} репутации.")
-        await safe_send_message(uid, f"🔻 У вас снято {amount} репутации администратором.")
+        safe_send_message_task(uid, f"🔻 У вас снято {amount} репутации администратором.")
     except Exception as e:
         logging.error(f"Remove reputation error: {e}")
         await message.answer("❌ Ошибка.")
@@ -3651,7 +4076,7 @@ async def add_exp_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может начислять опыт.")
         return
-    await message.answer("Введи ID или @username пользователя:", reply_markup=back_keyboard())
+    await message.answer("Введи ID или @username пользователя:", reply_markup=BACK_KB)
     await AddExp.user_id.set()
 
 @dp.message_handler(state=AddExp.user_id)
@@ -3695,7 +4120,7 @@ async def set_level_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может устанавливать уровень.")
         return
-    await message.answer("Введи ID или @username пользователя:", reply_markup=back_keyboard())
+    await message.answer("Введи ID или @username пользователя:", reply_markup=BACK_KB)
     await SetLevel.user_id.set()
 
 @dp.message_handler(state=SetLevel.user_id)
@@ -3732,7 +4157,7 @@ async def set_level_value(message: types.Message, state: FSMContext):
         async with db_pool.acquire() as conn:
             await conn.execute("UPDATE users SET level=$1 WHERE user_id=$2", level, uid)
         await message.answer(f"✅ Пользователю {uid} установлен уровень {level}.")
-        await safe_send_message(uid, f"🔝 Ваш уровень изменён на {level} администратором.")
+        safe_send_message_task(uid, f"🔝 Ваш уровень изменён на {level} администратором.")
     except Exception as e:
         logging.error(f"Set level error: {e}")
         await message.answer("❌ Ошибка.")
@@ -3743,7 +4168,7 @@ async def find_user_start(message: types.Message):
     if not await is_admin(message.from_user.id):
         await message.answer("❌ У тебя нет прав администратора.")
         return
-    await message.answer("Введи ID или @username пользователя:", reply_markup=back_keyboard())
+    await message.answer("Введи ID или @username пользователя:", reply_markup=BACK_KB)
     await FindUser.query.set()
 
 @dp.message_handler(state=FindUser.query)
@@ -3789,84 +4214,131 @@ async def find_user_result(message: types.Message, state: FSMContext):
     await message.answer(text)
     await state.finish()
 
+# ----- Многошаговые формы создания -----
+class Field:
+    """Шаг формы: имя поля (совпадает с именем State в группе), подсказка и разбор ввода.
+
+    parse получает текст сообщения (или само сообщение, если заданы content_types)
+    и возвращает значение либо None, если ввод не распознан.
+    """
+    def __init__(self, name, prompt, parse=None, validate=None, error="❌ Неверное значение.",
+                 invalid=None, content_types=None):
+        self.name = name
+        self.prompt = prompt
+        self.parse = parse or (lambda text: text)
+        self.validate = validate
+        self.error = error
+        self.invalid = invalid or error
+        self.content_types = content_types
+
+async def start_form(message: types.Message, states_group, fields):
+    now = time.time()
+    # Брошенные формы (ушли в другое меню, не нажав «Назад») чистим по возрасту
+    for key in [k for k, (started, _) in form_drafts.items() if now - started > FORM_DRAFT_TTL]:
+        form_drafts.pop(key, None)
+    form_drafts[(message.chat.id, message.from_user.id)] = (now, {})
+    await message.answer(fields[0].prompt, reply_markup=BACK_KB)
+    await getattr(states_group, fields[0].name).set()
+
+def _form_step(field, next_field, next_state, fields, back, on_finish):
+    async def step(message: types.Message, state: FSMContext):
+        key = (message.chat.id, message.from_user.id)
+        if message.text == "◀️ Назад":
+            form_drafts.pop(key, None)
+            await state.finish()
+            await back(message)
+            return
+        value = field.parse(message if field.content_types else message.text)
+        if value is None:
+            await message.answer(field.error)
+            return
+        if field.validate and not field.validate(value):
+            await message.answer(field.invalid)
+            return
+        draft = form_drafts.get(key)
+        if draft is None:
+            # Состояние пережило перезапуск (или шаг попал на другой экземпляр), а черновик — нет
+            await state.finish()
+            await message.answer("⚠️ Данные формы потеряны, заполни её заново.")
+            await back(message)
+            return
+        draft[1][field.name] = value
+        if next_field:
+            await message.answer(next_field.prompt)
+            await next_state.set()
+            return
+        form_drafts.pop(key, None)
+        await state.finish()
+        data = draft[1]
+        if any(f.name not in data for f in fields):
+            await message.answer("⚠️ Данные формы потеряны, заполни её заново.")
+            await back(message)
+            return
+        await on_finish(message, data)
+    return step
+
+def register_form(states_group, fields, back, on_finish):
+    """Регистрирует обработчик на каждый шаг формы; после последнего вызывается on_finish(message, data)."""
+    for field, next_field in zip(fields, fields[1:] + [None]):
+        next_state = getattr(states_group, next_field.name) if next_field else None
+        dp.register_message_handler(
+            _form_step(field, next_field, next_state, fields, back, on_finish),
+            state=getattr(states_group, field.name),
+            content_types=field.content_types or ['text']
+        )
+
+def parse_datetime(text: str):
+    try:
+        return datetime.strptime(text, "%d.%m.%Y %H:%M")
+    except ValueError:
+        return None
+
+def parse_giveaway_media(message: types.Message):
+    if message.photo:
+        return message.photo[-1].file_id, 'photo'
+    if message.video:
+        return message.video.file_id, 'video'
+    if message.document:
+        return message.document.file_id, 'document'
+    if message.text and message.text.lower() == 'пропустить':
+        return None, None
+    return None
+
 # ----- Управление магазином -----
-@dp.message_handler(lambda message: message.text == "🛒 Управление магазином")
 async def admin_shop_menu(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может управлять магазином.")
         return
-    await message.answer("Управление магазином:", reply_markup=admin_shop_keyboard())
+    await message.answer("Управление магазином:", reply_markup=ADMIN_SHOP_KB)
 
-@dp.message_handler(lambda message: message.text == "➕ Добавить товар")
 async def add_shop_item_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может добавлять товары.")
         return
-    await message.answer("Введи название товара:", reply_markup=back_keyboard())
-    await AddShopItem.name.set()
-
-@dp.message_handler(state=AddShopItem.name)
-async def add_shop_item_name(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_shop_menu(message)
-        return
-    await state.update_data(name=message.text)
-    await message.answer("Введи описание товара:")
-    await AddShopItem.next()
-
-@dp.message_handler(state=AddShopItem.description)
-async def add_shop_item_description(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_shop_menu(message)
-        return
-    await state.update_data(description=message.text)
-    await message.answer("Введи цену (целое число):")
-    await AddShopItem.next()
-
-@dp.message_handler(state=AddShopItem.price)
-async def add_shop_item_price(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_shop_menu(message)
-        return
-    try:
-        price = int(message.text)
-        if price <= 0:
-            raise ValueError
-    except ValueError:
-        await message.answer("❌ Цена должна быть положительным целым числом.")
-        return
-    await state.update_data(price=price)
-    await message.answer("Введи количество товара (целое число, -1 для бесконечного):")
-    await AddShopItem.stock.set()
+    await start_form(message, AddShopItem, ADD_SHOP_ITEM_FORM)
 
-@dp.message_handler(state=AddShopItem.stock)
-async def add_shop_item_stock(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_shop_menu(message)
-        return
-    try:
-        stock = int(message.text)
-    except ValueError:
-        await message.answer("❌ Введи целое число.")
-        return
-    data = await state.get_data()
+async def add_shop_item_finish(message: types.Message, data: dict):
     try:
         async with db_pool.acquire() as conn:
             await conn.execute(
                 "INSERT INTO shop_items (name, description, price, stock) VALUES ($1, $2, $3, $4)",
-                data['name'], data['description'], data['price'], stock
+                data['name'], data['description'], data['price'], data['stock']
             )
-        await message.answer("✅ Товар добавлен!", reply_markup=admin_shop_keyboard())
+        await message.answer("✅ Товар добавлен!", reply_markup=ADMIN_SHOP_KB)
     except Exception as e:
         logging.error(f"Add shop item error: {e}")
         await message.answer("❌ Ошибка при добавлении товара.")
-    await state.finish()
 
-@dp.message_handler(lambda message: message.text == "➖ Удалить товар")
+ADD_SHOP_ITEM_FORM = [
+    Field('name', "Введи название товара:"),
+    Field('description', "Введи описание товара:"),
+    Field('price', "Введи цену (целое число):", parse=parse_int, validate=lambda v: v > 0,
+          error="❌ Цена должна быть положительным целым числом."),
+    Field('stock', "Введи количество товара (целое число, -1 для бесконечного):", parse=parse_int,
+          error="❌ Введи целое число."),
+]
+register_form(AddShopItem, ADD_SHOP_ITEM_FORM, back=admin_shop_menu, on_finish=add_shop_item_finish)
+
 async def remove_shop_item_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может удалять товары.")
@@ -3878,7 +4350,7 @@ async def remove_shop_item_start(message: types.Message):
             await message.answer("В магазине нет товаров.")
             return
         text = "Товары:\n" + "\n".join([f"ID {i['id']}: {i['name']}" for i in items])
-        await message.answer(text + "\n\nВведи ID товара для удаления:", reply_markup=back_keyboard())
+        await message.answer(text + "\n\nВведи ID товара для удаления:", reply_markup=BACK_KB)
     except Exception as e:
         logging.error(f"List items for remove error: {e}")
         await message.answer("❌ Ошибка.")
@@ -3891,75 +4363,89 @@ async def remove_shop_item(message: types.Message, state: FSMContext):
         await state.finish()
         await admin_shop_menu(message)
         return
-    try:
-        item_id = int(message.text)
-    except ValueError:
+    item_id = parse_int(message.text)
+    if item_id is None:
         await message.answer("❌ Введи число.")
         return
     try:
         async with db_pool.acquire() as conn:
             await conn.execute("DELETE FROM shop_items WHERE id=$1", item_id)
-        await message.answer("✅ Товар удалён, если существовал.", reply_markup=admin_shop_keyboard())
+        await message.answer("✅ Товар удалён, если существовал.", reply_markup=ADMIN_SHOP_KB)
     except Exception as e:
         logging.error(f"Remove shop item error: {e}")
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📋 Список товаров")
+async def render_shop_items(after_id: int = None, before_id: int = None):
+    # Keyset-пагинация по id вместо OFFSET
+    async with db_pool.acquire() as conn:
+        if before_id is not None:
+            items = await conn.fetch(
+                "SELECT id, name, description, price, stock FROM shop_items WHERE id < $1 ORDER BY id DESC LIMIT $2",
+                before_id, ITEMS_PER_PAGE + 1
+            )
+        else:
+            items = await conn.fetch(
+                "SELECT id, name, description, price, stock FROM shop_items WHERE id > $1 ORDER BY id LIMIT $2",
+                after_id or 0, ITEMS_PER_PAGE + 1
+            )
+    has_more = len(items) > ITEMS_PER_PAGE
+    items = items[:ITEMS_PER_PAGE]
+    if before_id is not None:
+        items.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after_id is not None, has_more
+    if not items:
+        return None, None
+    text = "📦 Товары:\n"
+    for item in items:
+        text += f"\nID {item['id']} | {item['name']}\n{item['description']}\n💰 {item['price']} | наличие: {item['stock'] if item['stock']!=-1 else '∞'}\n"
+    nav_buttons = []
+    if has_prev:
+        nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"shopitems_before_{items[0]['id']}"))
+    if has_next:
+        nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"shopitems_after_{items[-1]['id']}"))
+    kb = InlineKeyboardMarkup(inline_keyboard=[nav_buttons]) if nav_buttons else None
+    return text, kb
+
 async def list_shop_items(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может просматривать список товаров.")
         return
-    page = 1
-    try:
-        parts = message.text.split()
-        if len(parts) > 1:
-            page = int(parts[1])
-    except:
-        pass
-    offset = (page - 1) * ITEMS_PER_PAGE
     try:
-        async with db_pool.acquire() as conn:
-            total = await conn.fetchval("SELECT COUNT(*) FROM shop_items")
-            items = await conn.fetch(
-                "SELECT id, name, description, price, stock FROM shop_items ORDER BY id LIMIT $1 OFFSET $2",
-                ITEMS_PER_PAGE, offset
-            )
-        if not items:
+        text, kb = await render_shop_items()
+        if not text:
             await message.answer("В магазине нет товаров.")
             return
-        text = f"📦 Товары (страница {page}):\n"
-        for item in items:
-            text += f"\nID {item['id']} | {item['name']}\n{item['description']}\n💰 {item['price']} | наличие: {item['stock'] if item['stock']!=-1 else '∞'}\n"
-        kb = []
-        nav_buttons = []
-        if page > 1:
-            nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"shopitems_page_{page-1}"))
-        if offset + ITEMS_PER_PAGE < total:
-            nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"shopitems_page_{page+1}"))
-        if nav_buttons:
-            kb.append(nav_buttons)
-        if kb:
-            await message.answer(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
-        else:
-            await message.answer(text, reply_markup=admin_shop_keyboard())
+        await message.answer(text, reply_markup=kb or ADMIN_SHOP_KB)
     except Exception as e:
         logging.error(f"List shop items error: {e}")
         await message.answer("❌ Ошибка.")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("shopitems_page_"))
+@dp.callback_query_handler(lambda c: c.data.startswith(("shopitems_after_", "shopitems_before_")))
 async def shopitems_page_callback(callback: types.CallbackQuery):
-    page = int(callback.data.split("_")[2])
-    callback.message.text = f"📋 Список товаров {page}"
-    await list_shop_items(callback.message)
+    if not await is_super_admin(callback.from_user.id):
+        await callback.answer("Недостаточно прав", show_alert=True)
+        return
+    _, direction, item_id = callback.data.split("_")
+    try:
+        if direction == "before":
+            text, kb = await render_shop_items(before_id=int(item_id))
+        else:
+            text, kb = await render_shop_items(after_id=int(item_id))
+        await callback.message.edit_text(text or "В магазине нет товаров.", reply_markup=kb)
+    except MessageNotModified:
+        pass
+    except Exception as e:
+        logging.error(f"Shop items page error: {e}")
     await callback.answer()
 
-@dp.message_handler(lambda message: message.text == "✏️ Редактировать товар")
 async def edit_shop_item_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может редактировать товары.")
         return
-    await message.answer("Введи ID товара для редактирования:", reply_markup=back_keyboard())
+    await message.answer("Введи ID товара для редактирования:", reply_markup=BACK_KB)
     await EditShopItem.item_id.set()
 
 @dp.message_handler(state=EditShopItem.item_id)
@@ -3968,13 +4454,12 @@ async def edit_shop_item_field(message: types.Message, state: FSMContext):
         await state.finish()
         await admin_shop_menu(message)
         return
-    try:
-        item_id = int(message.text)
-    except ValueError:
+    item_id = parse_int(message.text)
+    if item_id is None:
         await message.answer("❌ Введи число.")
         return
     await state.update_data(item_id=item_id)
-    await message.answer("Что хочешь изменить? (price/stock)", reply_markup=back_keyboard())
+    await message.answer("Что хочешь изменить? (price/stock)")
     await EditShopItem.field.set()
 
 @dp.message_handler(state=EditShopItem.field)
@@ -3997,9 +4482,8 @@ async def edit_shop_item_final(message: types.Message, state: FSMContext):
         await state.finish()
         await admin_shop_menu(message)
         return
-    try:
-        value = int(message.text)
-    except ValueError:
+    value = parse_int(message.text)
+    if value is None:
         await message.answer("❌ Введи целое число.")
         return
     data = await state.get_data()
@@ -4008,219 +4492,254 @@ async def edit_shop_item_final(message: types.Message, state: FSMContext):
     try:
         async with db_pool.acquire() as conn:
             await conn.execute(f"UPDATE shop_items SET {field}=$1 WHERE id=$2", value, item_id)
-        await message.answer("✅ Товар обновлён.", reply_markup=admin_shop_keyboard())
+        await message.answer("✅ Товар обновлён.", reply_markup=ADMIN_SHOP_KB)
     except Exception as e:
         logging.error(f"Edit shop item error: {e}")
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "🛍️ Список покупок")
+async def render_pending_purchases(after_id: int = None, before_id: int = None):
+    # Keyset по (purchase_date, id); в callback_data только id, дату подставляет подзапрос
+    query = (
+        "SELECT p.id, u.user_id, u.username, s.name, p.purchase_date FROM purchases p "
+        "JOIN users u ON p.user_id = u.user_id JOIN shop_items s ON p.item_id = s.id "
+        "WHERE p.status='pending' "
+    )
+    async with db_pool.acquire() as conn:
+        if before_id is not None:
+            rows = await conn.fetch(
+                query + "AND (p.purchase_date, p.id) < (SELECT purchase_date, id FROM purchases WHERE id=$1) "
+                "ORDER BY p.purchase_date DESC, p.id DESC LIMIT $2",
+                before_id, ITEMS_PER_PAGE + 1
+            )
+        elif after_id is not None:
+            rows = await conn.fetch(
+                query + "AND (p.purchase_date, p.id) > (SELECT purchase_date, id FROM purchases WHERE id=$1) "
+                "ORDER BY p.purchase_date, p.id LIMIT $2",
+                after_id, ITEMS_PER_PAGE + 1
+            )
+        else:
+            rows = await conn.fetch(query + "ORDER BY p.purchase_date, p.id LIMIT $1", ITEMS_PER_PAGE + 1)
+    has_more = len(rows) > ITEMS_PER_PAGE
+    rows = rows[:ITEMS_PER_PAGE]
+    if before_id is not None:
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after_id is not None, has_more
+    if not rows:
+        return None, None
+    text = "🛍️ Необработанные покупки:\n"
+    kb = []
+    for row in rows:
+        text += f"\n🆔 {row['id']} | {row['user_id']} (@{row['username']})\nТовар: {row['name']}\nДата: {row['purchase_date']}\n"
+        kb.append(purchase_action_row(row['id']))
+    nav_buttons = []
+    if has_prev:
+        nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=purchases_page_cb.new(direction="before", pid=rows[0]['id'])))
+    if has_next:
+        nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=purchases_page_cb.new(direction="after", pid=rows[-1]['id'])))
+    if nav_buttons:
+        kb.append(nav_buttons)
+    return text, InlineKeyboardMarkup(inline_keyboard=kb)
+
 async def admin_purchases(message: types.Message):
     if not await is_admin(message.from_user.id):
         await message.answer("❌ У тебя нет прав администратора.")
         return
     try:
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch(
-                "SELECT p.id, u.user_id, u.username, s.name, p.purchase_date, p.status FROM purchases p "
-                "JOIN users u ON p.user_id = u.user_id JOIN shop_items s ON p.item_id = s.id "
-                "WHERE p.status='pending' ORDER BY p.purchase_date"
-            )
-        if not rows:
+        text, kb = await render_pending_purchases()
+        if not text:
             await message.answer("Нет необработанных покупок.")
             return
-        for row in rows:
-            pid, uid, username, item_name, date, status = row['id'], row['user_id'], row['username'], row['name'], row['purchase_date'], row['status']
-            text = f"🆔 {pid}\nПользователь: {uid} (@{username})\nТовар: {item_name}\nДата: {date}"
-            await message.answer(text, reply_markup=purchase_action_keyboard(pid))
+        await message.answer(text, reply_markup=kb)
     except Exception as e:
         logging.error(f"Admin purchases error: {e}")
         await message.answer("❌ Ошибка загрузки покупок.")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("purchase_done_"))
-async def purchase_done(callback: types.CallbackQuery):
+@dp.callback_query_handler(purchases_page_cb.filter())
+async def purchases_page_callback(callback: types.CallbackQuery, callback_data: dict):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Недостаточно прав", show_alert=True)
+        return
+    pid = int(callback_data['pid'])
+    try:
+        if callback_data['direction'] == "before":
+            text, kb = await render_pending_purchases(before_id=pid)
+        else:
+            text, kb = await render_pending_purchases(after_id=pid)
+        await callback.message.edit_text(text or "Нет необработанных покупок.", reply_markup=kb)
+    except MessageNotModified:
+        pass
+    except Exception as e:
+        logging.error(f"Purchases page error: {e}")
+    await callback.answer()
+
+async def refresh_pending_purchases(message: types.Message):
+    # После обработки покупки перерисовываем список с начала очереди
+    try:
+        text, kb = await render_pending_purchases()
+        await message.edit_text(text or "Нет необработанных покупок.", reply_markup=kb)
+    except MessageNotModified:
+        pass
+
+@dp.callback_query_handler(purchase_cb.filter(action="done"))
+async def purchase_done(callback: types.CallbackQuery, callback_data: dict):
     if not await is_admin(callback.from_user.id):
         await callback.answer("Недостаточно прав", show_alert=True)
         return
-    purchase_id = int(callback.data.split("_")[2])
+    purchase_id = int(callback_data['pid'])
     try:
         async with db_pool.acquire() as conn:
-            await conn.execute("UPDATE purchases SET status='completed' WHERE id=$1", purchase_id)
-            user_id = await conn.fetchval("SELECT user_id FROM purchases WHERE id=$1", purchase_id)
-            if user_id:
-                await safe_send_message(user_id, "✅ Твоя покупка обработана! Админ выслал подарок.")
+            user_id = await conn.fetchval("UPDATE purchases SET status='completed' WHERE id=$1 RETURNING user_id", purchase_id)
         await callback.answer("Покупка отмечена как выполненная")
-        await callback.message.delete()
+        if user_id:
+            safe_send_message_task(user_id, "✅ Твоя покупка обработана! Админ выслал подарок.")
+        await refresh_pending_purchases(callback.message)
     except Exception as e:
         logging.error(f"Purchase done error: {e}")
         await callback.answer("Ошибка", show_alert=True)
 
-@dp.callback_query_handler(lambda c: c.data.startswith("purchase_reject_"))
-async def purchase_reject(callback: types.CallbackQuery):
+@dp.callback_query_handler(purchase_cb.filter(action="reject"))
+async def purchase_reject(callback: types.CallbackQuery, callback_data: dict):
     if not await is_admin(callback.from_user.id):
         await callback.answer("Недостаточно прав", show_alert=True)
         return
-    purchase_id = int(callback.data.split("_")[2])
+    purchase_id = int(callback_data['pid'])
     try:
         async with db_pool.acquire() as conn:
-            await conn.execute("UPDATE purchases SET status='rejected' WHERE id=$1", purchase_id)
-            user_id = await conn.fetchval("SELECT user_id FROM purchases WHERE id=$1", purchase_id)
-            if user_id:
-                await safe_send_message(user_id, "❌ К сожалению, твоя покупка не может быть выполнена. Свяжись с админом.")
+            user_id = await conn.fetchval("UPDATE purchases SET status='rejected' WHERE id=$1 RETURNING user_id", purchase_id)
         await callback.answer("Покупка отклонена")
-        await callback.message.delete()
+        if user_id:
+            safe_send_message_task(user_id, "❌ К сожалению, твоя покупка не может быть выполнена. Свяжись с админом.")
+        await refresh_pending_purchases(callback.message)
     except Exception as e:
         logging.error(f"Purchase reject error: {e}")
         await callback.answer("Ошибка", show_alert=True)
 
 # ----- Управление розыгрышами -----
-@dp.message_handler(lambda message: message.text == "🎁 Управление розыгрышами")
 async def admin_giveaway_menu(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может управлять розыгрышами.")
         return
-    await message.answer("Управление розыгрышами:", reply_markup=admin_giveaway_keyboard())
+    await message.answer("Управление розыгрышами:", reply_markup=ADMIN_GIVEAWAY_KB)
 
-@dp.message_handler(lambda message: message.text == "➕ Создать розыгрыш")
 async def create_giveaway_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может создавать розыгрыши.")
         return
-    await message.answer("Введи название приза:", reply_markup=back_keyboard())
-    await CreateGiveaway.prize.set()
-
-@dp.message_handler(state=CreateGiveaway.prize)
-async def create_giveaway_prize(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_giveaway_menu(message)
-        return
-    await state.update_data(prize=message.text)
-    await message.answer("Введи описание розыгрыша:")
-    await CreateGiveaway.description.set()
-
-@dp.message_handler(state=CreateGiveaway.description)
-async def create_giveaway_description(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_giveaway_menu(message)
-        return
-    await state.update_data(description=message.text)
-    await message.answer("Введи дату окончания в формате ДД.ММ.ГГГГ ЧЧ:ММ (например, 31.12.2025 23:59):")
-    await CreateGiveaway.end_date.set()
-
-@dp.message_handler(state=CreateGiveaway.end_date)
-async def create_giveaway_end_date(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_giveaway_menu(message)
-        return
-    try:
-        end_date = datetime.strptime(message.text, "%d.%m.%Y %H:%M")
-        if end_date <= datetime.now():
-            await message.answer("Дата окончания должна быть в будущем.")
-            return
-        await state.update_data(end_date=end_date.strftime("%Y-%m-%d %H:%M:%S"))
-    except ValueError:
-        await message.answer("Неверный формат. Используй ДД.ММ.ГГГГ ЧЧ:ММ")
-        return
-    await message.answer("Отправь медиа (фото, видео или документ) для розыгрыша или отправь 'пропустить':")
-    await CreateGiveaway.media.set()
-
-@dp.message_handler(state=CreateGiveaway.media, content_types=['text', 'photo', 'video', 'document'])
-async def create_giveaway_media(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_giveaway_menu(message)
-        return
-    data = await state.get_data()
-    media_file_id = None
-    media_type = None
-    if message.photo:
-        media_file_id = message.photo[-1].file_id
-        media_type = 'photo'
-    elif message.video:
-        media_file_id = message.video.file_id
-        media_type = 'video'
-    elif message.document:
-        media_file_id = message.document.file_id
-        media_type = 'document'
-    elif message.text and message.text.lower() == 'пропустить':
-        pass
-    else:
-        await message.answer("Пожалуйста, отправь фото, видео, документ или 'пропустить'.")
-        return
+    await start_form(message, CreateGiveaway, CREATE_GIVEAWAY_FORM)
 
+async def create_giveaway_finish(message: types.Message, data: dict):
+    media_file_id, media_type = data['media']
     try:
         async with db_pool.acquire() as conn:
             await conn.execute(
                 "INSERT INTO giveaways (prize, description, end_date, media_file_id, media_type) VALUES ($1, $2, $3, $4, $5)",
                 data['prize'], data['description'], data['end_date'], media_file_id, media_type
             )
-        await message.answer("✅ Розыгрыш создан!", reply_markup=admin_giveaway_keyboard())
+        await message.answer("✅ Розыгрыш создан!", reply_markup=ADMIN_GIVEAWAY_KB)
     except Exception as e:
         logging.error(f"Create giveaway error: {e}")
         await message.answer("❌ Ошибка при создании розыгрыша.")
-    await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📋 Активные розыгрыши")
+CREATE_GIVEAWAY_FORM = [
+    Field('prize', "Введи название приза:"),
+    Field('description', "Введи описание розыгрыша:"),
+    Field('end_date', "Введи дату окончания в формате ДД.ММ.ГГГГ ЧЧ:ММ (например, 31.12.2025 23:59):",
+          parse=parse_datetime, validate=lambda d: d > datetime.now(),
+          error="Неверный формат. Используй ДД.ММ.ГГГГ ЧЧ:ММ", invalid="Дата окончания должна быть в будущем."),
+    Field('media', "Отправь медиа (фото, видео или документ) для розыгрыша или отправь 'пропустить':",
+          parse=parse_giveaway_media, error="Пожалуйста, отправь фото, видео, документ или 'пропустить'.",
+          content_types=['text', 'photo', 'video', 'document']),
+]
+register_form(CreateGiveaway, CREATE_GIVEAWAY_FORM, back=admin_giveaway_menu, on_finish=create_giveaway_finish)
+
+# Курсор (end_date, id) в callback_data: дата целиком, с микросекундами, иначе строки
+# с одинаковой секундой повторялись бы на соседних страницах
+GIVEAWAY_CURSOR_FORMAT = "%Y%m%d%H%M%S%f"
+
+async def render_active_giveaways(after: tuple = None, before: tuple = None):
+    # Keyset-пагинация по (end_date, id): курсор передаётся в callback_data,
+    # поэтому страница не зависит от OFFSET и не требует COUNT(*).
+    # Розыгрыши без даты окончания (пустая дата из старого TEXT-столбца) в список не попадают
+    if before is not None:
+        cond, order, args = "AND (g.end_date, g.id) < ($1, $2) ", " DESC", before
+    elif after is not None:
+        cond, order, args = "AND (g.end_date, g.id) > ($1, $2) ", "", after
+    else:
+        cond, order, args = "", "", ()
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT g.id, g.prize, g.end_date, g.description, COUNT(p.user_id) AS participants_count "
+            "FROM giveaways g LEFT JOIN participants p ON p.giveaway_id = g.id "
+            f"WHERE g.status='active' AND g.end_date IS NOT NULL {cond}GROUP BY g.id "
+            f"ORDER BY g.end_date{order}, g.id{order} LIMIT ${len(args) + 1}",
+            *args, ITEMS_PER_PAGE + 1
+        )
+    has_more = len(rows) > ITEMS_PER_PAGE
+    rows = rows[:ITEMS_PER_PAGE]
+    if before is not None:
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after is not None, has_more
+    if not rows:
+        return None, None
+    text = "Активные розыгрыши:\n"
+    for row in rows:
+        gid, prize, end, desc, count = row['id'], row['prize'], row['end_date'], row['description'], row['participants_count']
+        text += f"ID: {gid} | {prize} | до {end} | 👥 {count} участников\n{desc}\n\n"
+    nav_buttons = []
+    if has_prev:
+        first = rows[0]
+        nav_buttons.append(InlineKeyboardButton(
+            text="⬅️", callback_data=f"activegiveaways_before_{first['end_date'].strftime(GIVEAWAY_CURSOR_FORMAT)}_{first['id']}"))
+    if has_next:
+        last = rows[-1]
+        nav_buttons.append(InlineKeyboardButton(
+            text="➡️", callback_data=f"activegiveaways_after_{last['end_date'].strftime(GIVEAWAY_CURSOR_FORMAT)}_{last['id']}"))
+    kb = InlineKeyboardMarkup(inline_keyboard=[nav_buttons]) if nav_buttons else None
+    return text, kb
+
 async def list_active_giveaways(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может просматривать активные розыгрыши.")
         return
-    page = 1
     try:
-        parts = message.text.split()
-        if len(parts) > 1:
-            page = int(parts[1])
-    except:
-        pass
-    offset = (page - 1) * ITEMS_PER_PAGE
-    try:
-        async with db_pool.acquire() as conn:
-            total = await conn.fetchval("SELECT COUNT(*) FROM giveaways WHERE status='active'")
-            rows = await conn.fetch(
-                "SELECT id, prize, end_date, description FROM giveaways WHERE status='active' ORDER BY end_date LIMIT $1 OFFSET $2",
-                ITEMS_PER_PAGE, offset
-            )
-        if not rows:
+        text, kb = await render_active_giveaways()
+        if not text:
             await message.answer("Нет активных розыгрышей.")
             return
-        text = f"Активные розыгрыши (страница {page}):\n"
-        for row in rows:
-            gid, prize, end, desc = row['id'], row['prize'], row['end_date'], row['description']
-            async with db_pool.acquire() as conn2:
-                count = await conn2.fetchval("SELECT COUNT(*) FROM participants WHERE giveaway_id=$1", gid)
-            text += f"ID: {gid} | {prize} | до {end} | 👥 {count} участников\n{desc}\n\n"
-        kb = []
-        nav_buttons = []
-        if page > 1:
-            nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"activegiveaways_page_{page-1}"))
-        if offset + ITEMS_PER_PAGE < total:
-            nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"activegiveaways_page_{page+1}"))
-        if nav_buttons:
-            kb.append(nav_buttons)
-        if kb:
-            await message.answer(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
-        else:
-            await message.answer(text, reply_markup=admin_giveaway_keyboard())
+        await message.answer(text, reply_markup=kb or ADMIN_GIVEAWAY_KB)
     except Exception as e:
         logging.error(f"List giveaways error: {e}")
         await message.answer("❌ Ошибка.")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("activegiveaways_page_"))
+@dp.callback_query_handler(lambda c: c.data.startswith(("activegiveaways_after_", "activegiveaways_before_")))
 async def activegiveaways_page_callback(callback: types.CallbackQuery):
-    page = int(callback.data.split("_")[2])
-    callback.message.text = f"📋 Активные розыгрыши {page}"
-    await list_active_giveaways(callback.message)
+    if not await is_super_admin(callback.from_user.id):
+        await callback.answer("Недостаточно прав", show_alert=True)
+        return
+    _, direction, ts, gid = callback.data.split("_")
+    cursor = (datetime.strptime(ts, GIVEAWAY_CURSOR_FORMAT), int(gid))
+    try:
+        if direction == "before":
+            text, kb = await render_active_giveaways(before=cursor)
+        else:
+            text, kb = await render_active_giveaways(after=cursor)
+        await callback.message.edit_text(text or "Нет активных розыгрышей.", reply_markup=kb)
+    except MessageNotModified:
+        pass
+    except Exception as e:
+        logging.error(f"Active giveaways page error: {e}")
     await callback.answer()
 
-@dp.message_handler(lambda message: message.text == "✅ Завершить розыгрыш")
 async def finish_giveaway_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может завершать розыгрыши.")
         return
-    await message.answer("Введи ID розыгрыша, который нужно завершить:", reply_markup=back_keyboard())
+    await message.answer("Введи ID розыгрыша, который нужно завершить:", reply_markup=BACK_KB)
     await CompleteGiveaway.giveaway_id.set()
 
 @dp.message_handler(state=CompleteGiveaway.giveaway_id)
@@ -4229,9 +4748,8 @@ async def finish_giveaway(message: types.Message, state: FSMContext):
         await state.finish()
         await admin_giveaway_menu(message)
         return
-    try:
-        gid = int(message.text)
-    except ValueError:
+    gid = parse_int(message.text)
+    if gid is None:
         await message.answer("❌ Введи число.")
         return
     await state.update_data(giveaway_id=gid)
@@ -4244,11 +4762,8 @@ async def finish_giveaway_winners(message: types.Message, state: FSMContext):
         await state.finish()
         await admin_giveaway_menu(message)
         return
-    try:
-        winners_count = int(message.text)
-        if winners_count < 1:
-            raise ValueError
-    except ValueError:
+    winners_count = parse_int(message.text)
+    if winners_count is None or winners_count < 1:
         await message.answer("❌ Введи положительное целое число.")
         return
     data = await state.get_data()
@@ -4271,77 +4786,54 @@ async def finish_giveaway_winners(message: types.Message, state: FSMContext):
             winners = random.sample(participants, winners_count)
             await conn.execute("UPDATE giveaways SET status='completed', winner_id=$1 WHERE id=$2", winners[0], gid)
             for wid in winners:
-                await safe_send_message(wid, f"🎉 Поздравляем! Ты выиграл в розыгрыше! Свяжись с админом.")
-        await message.answer(f"🏆 Победители выбраны! ({len(winners)})", reply_markup=admin_giveaway_keyboard())
+                safe_send_message_task(wid, f"🎉 Поздравляем! Ты выиграл в розыгрыше! Свяжись с админом.")
+        await message.answer(f"🏆 Победители выбраны! ({len(winners)})", reply_markup=ADMIN_GIVEAWAY_KB)
     except Exception as e:
         logging.error(f"Finish giveaway error: {e}")
         await message.answer("❌ Ошибка.")
     await state.finish()
 
 # ----- Управление каналами (для подписки) -----
-@dp.message_handler(lambda message: message.text == "📢 Управление каналами")
 async def admin_channel_menu(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может управлять каналами.")
         return
-    await message.answer("Управление каналами:", reply_markup=admin_channel_keyboard())
+    await message.answer("Управление каналами:", reply_markup=ADMIN_CHANNEL_KB)
 
-@dp.message_handler(lambda message: message.text == "➕ Добавить канал")
 async def add_channel_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может добавлять каналы.")
         return
-    await message.answer("Введи chat_id канала (можно получить у @username_to_id_bot):", reply_markup=back_keyboard())
-    await AddChannel.chat_id.set()
-
-@dp.message_handler(state=AddChannel.chat_id)
-async def add_channel_chat_id(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_channel_menu(message)
-        return
-    await state.update_data(chat_id=message.text.strip())
-    await message.answer("Введи название канала:")
-    await AddChannel.next()
+    await start_form(message, AddChannel, ADD_CHANNEL_FORM)
 
-@dp.message_handler(state=AddChannel.title)
-async def add_channel_title(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_channel_menu(message)
-        return
-    await state.update_data(title=message.text)
-    await message.answer("Введи invite-ссылку (или отправь 'нет'):")
-    await AddChannel.next()
-
-@dp.message_handler(state=AddChannel.invite_link)
-async def add_channel_link(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_channel_menu(message)
-        return
-    link = None if message.text.lower() == 'нет' else message.text.strip()
-    data = await state.get_data()
+async def add_channel_finish(message: types.Message, data: dict):
     try:
         async with db_pool.acquire() as conn:
             await conn.execute(
                 "INSERT INTO channels (chat_id, title, invite_link) VALUES ($1, $2, $3)",
-                data['chat_id'], data['title'], link
+                data['chat_id'], data['title'], data['invite_link'] or None
             )
-        await message.answer("✅ Канал добавлен!", reply_markup=admin_channel_keyboard())
+        await message.answer("✅ Канал добавлен!", reply_markup=ADMIN_CHANNEL_KB)
     except asyncpg.UniqueViolationError:
         await message.answer("❌ Канал с таким chat_id уже существует.")
     except Exception as e:
         logging.error(f"Add channel error: {e}")
         await message.answer("❌ Ошибка.")
-    await state.finish()
 
-@dp.message_handler(lambda message: message.text == "➖ Удалить канал")
+ADD_CHANNEL_FORM = [
+    Field('chat_id', "Введи chat_id канала (можно получить у @username_to_id_bot):", parse=str.strip),
+    Field('title', "Введи название канала:"),
+    # 'нет' сохраняется как пустая строка и превращается в NULL при вставке
+    Field('invite_link', "Введи invite-ссылку (или отправь 'нет'):",
+          parse=lambda text: '' if text.lower() == 'нет' else text.strip()),
+]
+register_form(AddChannel, ADD_CHANNEL_FORM, back=admin_channel_menu, on_finish=add_channel_finish)
+
 async def remove_channel_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может удалять каналы.")
         return
-    await message.answer("Введи chat_id канала для удаления:", reply_markup=back_keyboard())
+    await message.answer("Введи chat_id канала для удаления:", reply_markup=BACK_KB)
     await RemoveChannel.chat_id.set()
 
 @dp.message_handler(state=RemoveChannel.chat_id)
@@ -4354,13 +4846,12 @@ async def remove_channel(message: types.Message, state: FSMContext):
     try:
         async with db_pool.acquire() as conn:
             await conn.execute("DELETE FROM channels WHERE chat_id=$1", chat_id)
-        await message.answer("✅ Канал удалён, если существовал.", reply_markup=admin_channel_keyboard())
+        await message.answer("✅ Канал удалён, если существовал.", reply_markup=ADMIN_CHANNEL_KB)
     except Exception as e:
         logging.error(f"Remove channel error: {e}")
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📋 Список каналов")
 async def list_channels(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может просматривать список каналов.")
@@ -4372,263 +4863,179 @@ async def list_channels(message: types.Message):
     text = "📺 Каналы для подписки:\n"
     for chat_id, title, link in channels:
         text += f"• {title} (chat_id: {chat_id})\n  Ссылка: {link or 'нет'}\n"
-    await message.answer(text, reply_markup=admin_channel_keyboard())
+    await message.answer(text, reply_markup=ADMIN_CHANNEL_KB)
 
 # ----- Управление промокодами -----
-@dp.message_handler(lambda message: message.text == "🎫 Управление промокодами")
 async def admin_promo_menu(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может управлять промокодами.")
         return
-    await message.answer("Управление промокодами:", reply_markup=admin_promo_keyboard())
+    await message.answer("Управление промокодами:", reply_markup=ADMIN_PROMO_KB)
 
-@dp.message_handler(lambda message: message.text == "➕ Создать промокод")
 async def create_promo_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может создавать промокоды.")
         return
-    await message.answer("Введи код промокода (латиница, цифры):", reply_markup=back_keyboard())
-    await CreatePromocode.code.set()
-
-@dp.message_handler(state=CreatePromocode.code)
-async def create_promo_code(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_promo_menu(message)
-        return
-    code = message.text.strip().upper()
-    await state.update_data(code=code)
-    await message.answer("Введи количество монет, которые даёт промокод:")
-    await CreatePromocode.next()
+    await start_form(message, CreatePromocode, CREATE_PROMO_FORM)
 
-@dp.message_handler(state=CreatePromocode.reward)
-async def create_promo_reward(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_promo_menu(message)
-        return
-    try:
-        reward = int(message.text)
-        if reward <= 0:
-            raise ValueError
-    except ValueError:
-        await message.answer("❌ Введи положительное целое число.")
-        return
-    await state.update_data(reward=reward)
-    await message.answer("Введи максимальное количество использований:")
-    await CreatePromocode.next()
-
-@dp.message_handler(state=CreatePromocode.max_uses)
-async def create_promo_max_uses(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_promo_menu(message)
-        return
-    try:
-        max_uses = int(message.text)
-        if max_uses <= 0:
-            raise ValueError
-    except ValueError:
-        await message.answer("❌ Введи положительное целое число.")
-        return
-    data = await state.get_data()
+async def create_promo_finish(message: types.Message, data: dict):
     try:
         async with db_pool.acquire() as conn:
             await conn.execute(
                 "INSERT INTO promocodes (code, reward, max_uses, created_at) VALUES ($1, $2, $3, $4)",
-                data['code'], data['reward'], max_uses, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                data['code'], data['reward'], data['max_uses'], datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             )
-        await message.answer("✅ Промокод создан!", reply_markup=admin_promo_keyboard())
+        await message.answer("✅ Промокод создан!", reply_markup=ADMIN_PROMO_KB)
     except asyncpg.UniqueViolationError:
         await message.answer("❌ Промокод с таким кодом уже существует.")
     except Exception as e:
         logging.error(f"Create promo error: {e}")
         await message.answer("❌ Ошибка.")
-    await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📋 Список промокодов")
+# Код попадает в callback_data пагинации ("promos:before:<код>", не больше 64 байт),
+# поэтому только ASCII без ':' и с ограничением длины
+PROMO_CODE_RE = re.compile(r"[A-Z0-9_-]{1,32}")
+
+CREATE_PROMO_FORM = [
+    Field('code', "Введи код промокода (латиница, цифры, _ и -, до 32 символов):", parse=lambda text: text.strip().upper(),
+          validate=lambda v: PROMO_CODE_RE.fullmatch(v) is not None,
+          error="❌ Код может содержать только латиницу, цифры, _ и -, не длиннее 32 символов."),
+    Field('reward', "Введи количество монет, которые даёт промокод:", parse=parse_int,
+          validate=lambda v: v > 0, error="❌ Введи положительное целое число."),
+    Field('max_uses', "Введи максимальное количество использований:", parse=parse_int,
+          validate=lambda v: v > 0, error="❌ Введи положительное целое число."),
+]
+register_form(CreatePromocode, CREATE_PROMO_FORM, back=admin_promo_menu, on_finish=create_promo_finish)
+
+def promo_cursor(code: str) -> str:
+    """Курсор страницы промокодов для callback_data.
+
+    Коды, созданные до PROMO_CODE_RE, могут содержать ':' или не помещаться в 64 байта
+    (кириллица), поэтому для них в кнопку кладётся '#' + начало md5, а код ищется в БД.
+    """
+    if PROMO_CODE_RE.fullmatch(code):
+        return code
+    return "#" + hashlib.md5(code.encode()).hexdigest()[:16]
+
+async def render_promos(after: str = None, before: str = None):
+    # Keyset-пагинация по коду промокода (первичный ключ) вместо OFFSET + COUNT(*)
+    async with db_pool.acquire() as conn:
+        cursor = before if before is not None else after
+        if cursor is not None and cursor.startswith("#"):
+            code = await conn.fetchval(
+                "SELECT code FROM promocodes WHERE left(md5(code), 16) = $1 ORDER BY code LIMIT 1",
+                cursor[1:]
+            )
+            if code is None:
+                # Промокод-курсор успели удалить — показываем первую страницу
+                after = before = None
+            elif before is not None:
+                before = code
+            else:
+                after = code
+        if before is not None:
+            rows = await conn.fetch(
+                "SELECT code, reward, max_uses, used_count FROM promocodes WHERE code < $1 ORDER BY code DESC LIMIT $2",
+                before, ITEMS_PER_PAGE + 1
+            )
+        else:
+            rows = await conn.fetch(
+                "SELECT code, reward, max_uses, used_count FROM promocodes WHERE code > $1 ORDER BY code LIMIT $2",
+                after or "", ITEMS_PER_PAGE + 1
+            )
+    has_more = len(rows) > ITEMS_PER_PAGE
+    rows = rows[:ITEMS_PER_PAGE]
+    if before is not None:
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after is not None, has_more
+    if not rows:
+        return None, None
+    text = "🎫 Промокоды:\n"
+    for row in rows:
+        text += f"• {row['code']}: {row['reward']} монет, использовано {row['used_count']}/{row['max_uses']}\n"
+    nav_buttons = []
+    if has_prev:
+        nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=promos_page_cb.new(direction="before", code=promo_cursor(rows[0]['code']))))
+    if has_next:
+        nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=promos_page_cb.new(direction="after", code=promo_cursor(rows[-1]['code']))))
+    kb = InlineKeyboardMarkup(inline_keyboard=[nav_buttons]) if nav_buttons else None
+    return text, kb
+
 async def list_promos(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может просматривать список промокодов.")
         return
-    page = 1
-    try:
-        parts = message.text.split()
-        if len(parts) > 1:
-            page = int(parts[1])
-    except:
-        pass
-    offset = (page - 1) * ITEMS_PER_PAGE
     try:
-        async with db_pool.acquire() as conn:
-            total = await conn.fetchval("SELECT COUNT(*) FROM promocodes")
-            rows = await conn.fetch(
-                "SELECT code, reward, max_uses, used_count FROM promocodes LIMIT $1 OFFSET $2",
-                ITEMS_PER_PAGE, offset
-            )
-        if not rows:
+        text, kb = await render_promos()
+        if not text:
             await message.answer("Нет промокодов.")
             return
-        text = f"🎫 Промокоды (страница {page}):\n"
-        for row in rows:
-            text += f"• {row['code']}: {row['reward']} монет, использовано {row['used_count']}/{row['max_uses']}\n"
-        kb = []
-        nav_buttons = []
-        if page > 1:
-            nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"promos_page_{page-1}"))
-        if offset + ITEMS_PER_PAGE < total:
-            nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"promos_page_{page+1}"))
-        if nav_buttons:
-            kb.append(nav_buttons)
-        if kb:
-            await message.answer(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
-        else:
-            await message.answer(text, reply_markup=admin_promo_keyboard())
+        await message.answer(text, reply_markup=kb or ADMIN_PROMO_KB)
     except Exception as e:
         logging.error(f"List promos error: {e}")
         await message.answer("❌ Ошибка.")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("promos_page_"))
-async def promos_page_callback(callback: types.CallbackQuery):
-    page = int(callback.data.split("_")[2])
-    callback.message.text = f"📋 Список промокодов {page}"
-    await list_promos(callback.message)
+@dp.callback_query_handler(promos_page_cb.filter())
+async def promos_page_callback(callback: types.CallbackQuery, callback_data: dict):
+    if not await is_super_admin(callback.from_user.id):
+        await callback.answer("Недостаточно прав", show_alert=True)
+        return
+    code = callback_data['code']
+    try:
+        if callback_data['direction'] == "before":
+            text, kb = await render_promos(before=code)
+        else:
+            text, kb = await render_promos(after=code)
+        await callback.message.edit_text(text or "Нет промокодов.", reply_markup=kb)
+    except MessageNotModified:
+        pass
+    except Exception as e:
+        logging.error(f"Promos page error: {e}")
     await callback.answer()
 
 # ----- Управление заданиями -----
-@dp.message_handler(lambda message: message.text == "📋 Управление заданиями")
 async def admin_tasks_menu(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может управлять заданиями.")
         return
-    await message.answer("Управление заданиями:", reply_markup=admin_tasks_keyboard())
+    await message.answer("Управление заданиями:", reply_markup=ADMIN_TASKS_KB)
 
-@dp.message_handler(lambda message: message.text == "➕ Создать задание")
 async def create_task_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может создавать задания.")
         return
-    await message.answer("Введи название задания:", reply_markup=back_keyboard())
-    await CreateTask.name.set()
-
-@dp.message_handler(state=CreateTask.name)
-async def create_task_name(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_tasks_menu(message)
-        return
-    await state.update_data(name=message.text)
-    await message.answer("Введи описание задания:")
-    await CreateTask.next()
-
-@dp.message_handler(state=CreateTask.description)
-async def create_task_description(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_tasks_menu(message)
-        return
-    await state.update_data(description=message.text)
-    await message.answer("Введи тип задания (subscribe):")
-    await CreateTask.next()
-
-@dp.message_handler(state=CreateTask.task_type)
-async def create_task_type(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_tasks_menu(message)
-        return
-    task_type = message.text.lower()
-    if task_type not in ['subscribe']:
-        await message.answer("Поддерживается только 'subscribe'")
-        return
-    await state.update_data(task_type=task_type)
-    await message.answer("Введи ID канала (с -100) для подписки:")
-    await CreateTask.next()
+    await start_form(message, CreateTask, CREATE_TASK_FORM)
 
-@dp.message_handler(state=CreateTask.target_id)
-async def create_task_target(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_tasks_menu(message)
-        return
-    await state.update_data(target_id=message.text.strip())
-    await message.answer("Введи награду (монеты):")
-    await CreateTask.next()
-
-@dp.message_handler(state=CreateTask.reward_coins)
-async def create_task_reward_coins(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_tasks_menu(message)
-        return
-    try:
-        coins = int(message.text)
-    except:
-        await message.answer("Введи целое число.")
-        return
-    await state.update_data(reward_coins=coins)
-    await message.answer("Введи награду (репутация):")
-    await CreateTask.next()
-
-@dp.message_handler(state=CreateTask.reward_reputation)
-async def create_task_reward_rep(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_tasks_menu(message)
-        return
-    try:
-        rep = int(message.text)
-    except:
-        await message.answer("Введи целое число.")
-        return
-    await state.update_data(reward_reputation=rep)
-    await message.answer("Сколько дней нужно быть подписанным? (0 - не проверять):")
-    await CreateTask.next()
-
-@dp.message_handler(state=CreateTask.required_days)
-async def create_task_required_days(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_tasks_menu(message)
-        return
-    try:
-        days = int(message.text)
-        if days < 0:
-            raise ValueError
-    except:
-        await message.answer("Введи неотрицательное целое число.")
-        return
-    await state.update_data(required_days=days)
-    await message.answer("Штрафных дней (если отписался раньше, 0 - нет штрафа):")
-    await CreateTask.next()
-
-@dp.message_handler(state=CreateTask.penalty_days)
-async def create_task_penalty_days(message: types.Message, state: FSMContext):
-    if message.text == "◀️ Назад":
-        await state.finish()
-        await admin_tasks_menu(message)
-        return
-    try:
-        days = int(message.text)
-        if days < 0:
-            raise ValueError
-    except:
-        await message.answer("Введи неотрицательное целое число.")
-        return
-    data = await state.get_data()
+async def create_task_finish(message: types.Message, data: dict):
     try:
         async with db_pool.acquire() as conn:
             await conn.execute(
                 "INSERT INTO tasks (name, description, task_type, target_id, reward_coins, reward_reputation, required_days, penalty_days, created_by, created_at, active) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, TRUE)",
-                data['name'], data['description'], data['task_type'], data['target_id'], data['reward_coins'], data['reward_reputation'], data['required_days'], days, message.from_user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                data['name'], data['description'], data['task_type'], data['target_id'], data['reward_coins'], data['reward_reputation'], data['required_days'], data['penalty_days'], message.from_user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             )
-        await message.answer("✅ Задание создано!", reply_markup=admin_tasks_keyboard())
+        await get_active_tasks(force_update=True)
+        await message.answer("✅ Задание создано!", reply_markup=ADMIN_TASKS_KB)
     except Exception as e:
         logging.error(f"Create task error: {e}")
         await message.answer("❌ Ошибка при создании задания.")
-    await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📋 Список заданий")
+CREATE_TASK_FORM = [
+    Field('name', "Введи название задания:"),
+    Field('description', "Введи описание задания:"),
+    Field('task_type', "Введи тип задания (subscribe):", parse=str.lower,
+          validate=lambda v: v in ('subscribe',), error="Поддерживается только 'subscribe'"),
+    Field('target_id', "Введи ID канала (с -100) для подписки:", parse=str.strip),
+    Field('reward_coins', "Введи награду (монеты):", parse=parse_int, error="Введи целое число."),
+    Field('reward_reputation', "Введи награду (репутация):", parse=parse_int, error="Введи целое число."),
+    Field('required_days', "Сколько дней нужно быть подписанным? (0 - не проверять):", parse=parse_int,
+          validate=lambda v: v >= 0, error="Введи неотрицательное целое число."),
+    Field('penalty_days', "Штрафных дней (если отписался раньше, 0 - нет штрафа):", parse=parse_int,
+          validate=lambda v: v >= 0, error="Введи неотрицательное целое число."),
+]
+register_form(CreateTask, CREATE_TASK_FORM, back=admin_tasks_menu, on_finish=create_task_finish)
+
 async def list_tasks(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может просматривать список заданий.")
@@ -4641,14 +5048,13 @@ async def list_tasks(message: types.Message):
     text = "📋 Задания:\n"
     for row in rows:
         text += f"ID {row['id']}: {row['name']} ({'активно' if row['active'] else 'неактивно'})\n"
-    await message.answer(text, reply_markup=admin_tasks_keyboard())
+    await message.answer(text, reply_markup=ADMIN_TASKS_KB)
 
-@dp.message_handler(lambda message: message.text == "❌ Удалить задание")
 async def delete_task_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может удалять задания.")
         return
-    await message.answer("Введи ID задания для удаления (деактивации):", reply_markup=back_keyboard())
+    await message.answer("Введи ID задания для удаления (деактивации):", reply_markup=BACK_KB)
     await DeleteTask.task_id.set()
 
 @dp.message_handler(state=DeleteTask.task_id)
@@ -4657,16 +5063,46 @@ async def delete_task_finish(message: types.Message, state: FSMContext):
         await state.finish()
         await admin_tasks_menu(message)
         return
-    try:
-        task_id = int(message.text)
-    except:
+    task_id = parse_int(message.text)
+    if task_id is None:
         await message.answer("Введи число.")
         return
     async with db_pool.acquire() as conn:
         await conn.execute("UPDATE tasks SET active=FALSE WHERE id=$1", task_id)
-    await message.answer("✅ Задание деактивировано.", reply_markup=admin_tasks_keyboard())
+    await get_active_tasks(force_update=True)
+    await message.answer("✅ Задание деактивировано.", reply_markup=ADMIN_TASKS_KB)
     await state.finish()
 
+# ----- Маршрутизация кнопок админ-меню -----
+# Один обработчик с поиском по словарю вместо отдельного фильтра на каждую кнопку
+TEXT_ROUTES = {
+    "🛒 Управление магазином": admin_shop_menu,
+    "➕ Добавить товар": add_shop_item_start,
+    "➖ Удалить товар": remove_shop_item_start,
+    "📋 Список товаров": list_shop_items,
+    "✏️ Редактировать товар": edit_shop_item_start,
+    "🛍️ Список покупок": admin_purchases,
+    "🎁 Управление розыгрышами": admin_giveaway_menu,
+    "➕ Создать розыгрыш": create_giveaway_start,
+    "📋 Активные розыгрыши": list_active_giveaways,
+    "✅ Завершить розыгрыш": finish_giveaway_start,
+    "📢 Управление каналами": admin_channel_menu,
+    "➕ Добавить канал": add_channel_start,
+    "➖ Удалить канал": remove_channel_start,
+    "📋 Список каналов": list_channels,
+    "🎫 Управление промокодами": admin_promo_menu,
+    "➕ Создать промокод": create_promo_start,
+    "📋 Список промокодов": list_promos,
+    "📋 Управление заданиями": admin_tasks_menu,
+    "➕ Создать задание": create_task_start,
+    "📋 Список заданий": list_tasks,
+    "❌ Удалить задание": delete_task_start,
+}
+
+@dp.message_handler(lambda message: message.text in TEXT_ROUTES)
+async def admin_text_router(message: types.Message):
+    await TEXT_ROUTES[message.text](message)
+
 # ----- Управление чатами (подтверждение, список) -----
 @dp.message_handler(lambda message: message.text == "🤖 Управление чатами")
 async def admin_chats_menu(message: types.Message):
@@ -4692,7 +5128,7 @@ async def list_pending_requests(message: types.Message):
 async def confirm_chat_manual(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         return
-    await message.answer("Введи ID чата, который хочешь подтвердить:", reply_markup=back_keyboard())
+    await message.answer("Введи ID чата, который хочешь подтвердить:", reply_markup=BACK_KB)
     await ManageChats.chat_id.set()
     async with state.proxy() as data:
         data['action'] = "confirm"
@@ -4701,7 +5137,7 @@ async def confirm_chat_manual(message: types.Message):
 async def reject_chat_manual(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         return
-    await message.answer("Введи ID чата, запрос которого хочешь отклонить:", reply_markup=back_keyboard())
+    await message.answer("Введи ID чата, запрос которого хочешь отклонить:", reply_markup=BACK_KB)
     await ManageChats.chat_id.set()
     async with state.proxy() as data:
         data['action'] = "reject"
@@ -4710,7 +5146,7 @@ async def reject_chat_manual(message: types.Message):
 async def remove_confirmed_chat_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         return
-    await message.answer("Введи ID чата, который нужно удалить из подтверждённых:", reply_markup=back_keyboard())
+    await message.answer("Введи ID чата, который нужно удалить из подтверждённых:", reply_markup=BACK_KB)
     await ManageChats.chat_id.set()
     async with state.proxy() as data:
         data['action'] = "remove"
@@ -4751,7 +5187,7 @@ async def process_chat_id(message: types.Message, state: FSMContext):
             await add_confirmed_chat(chat_id, request['title'], request['type'], message.from_user.id)
             await update_chat_request_status(chat_id, 'approved')
             await message.answer(f"✅ Чат {request['title']} подтверждён.")
-            await safe_send_message(request['requested_by'], f"✅ Ваш чат «{request['title']}» активирован!")
+            safe_send_message_task(request['requested_by'], f"✅ Ваш чат «{request['title']}» активирован!")
         elif action == "reject":
             request = await conn.fetchrow("SELECT * FROM chat_confirmation_requests WHERE chat_id=$1", chat_id)
             if not request:
@@ -4760,7 +5196,7 @@ async def process_chat_id(message: types.Message, state: FSMContext):
                 return
             await update_chat_request_status(chat_id, 'rejected')
             await message.answer(f"❌ Запрос для чата {request['title']} отклонён.")
-            await safe_send_message(request['requested_by'], f"❌ Запрос на активацию чата «{request['title']}» отклонён.")
+            safe_send_message_task(request['requested_by'], f"❌ Запрос на активацию чата «{request['title']}» отклонён.")
         elif action == "remove":
             await remove_confirmed_chat(chat_id)
             await message.answer(f"✅ Чат {chat_id} удалён из подтверждённых.")
@@ -4792,7 +5228,7 @@ async def list_active_bosses(message: types.Message):
 async def manual_spawn_boss_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         return
-    await message.answer("Введи ID чата, где создать босса:", reply_markup=back_keyboard())
+    await message.answer("Введи ID чата, где создать босса:", reply_markup=BACK_KB)
     await BossSpawn.chat_id.set()
 
 @dp.message_handler(state=BossSpawn.chat_id)
@@ -4839,11 +5275,7 @@ async def settings_menu(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может изменять настройки игры.")
         return
-    settings = {}
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT key, value FROM settings")
-        for row in rows:
-            settings[row['key']] = row['value']
+    settings = await get_settings()
     text = "⚙️ <b>Текущие настройки игры:</b>\n\n"
     text += f"💰 Стоимость случайной кражи: {settings.get('random_attack_cost', '0')} монет\n"
     text += f"👤 Стоимость кражи по username: {settings.get('targeted_attack_cost', '50')} монет\n"
@@ -4896,84 +5328,69 @@ async def settings_menu(message: types.Message):
     text += "Выбери параметр для изменения (нажми на кнопку):"
     await message.answer(text, reply_markup=settings_reply_keyboard())
 
-@dp.message_handler(lambda message: message.text in [
-    "💰 Стоимость случайной кражи", "👤 Стоимость кражи по username", "⏱ Кулдаун (минут)",
-    "🎲 Шанс успеха %", "🛡 Шанс защиты %", "💥 Штраф при защите", "🎰 Шанс казино %",
-    "💰 Мин. сумма кражи", "💰 Макс. сумма кражи", "🎲 Множитель костей", "🔢 Множитель угадайки",
-    "⭐️ Репутация за угадайку", "📢 Уведомления в чатах", "💰 Сумма подарка в чате",
-    "📊 Лимит подарков в день", "👥 Реферальный бонус (монеты)", "⭐️ Реферальный бонус (репутация)",
-    "📈 Опыт за казино (победа)", "📉 Опыт за казино (поражение)", "🎲 Опыт за кости (победа)",
-    "🎲 Опыт за кости (поражение)", "🔢 Опыт за угадайку (победа)", "🔢 Опыт за угадайку (поражение)",
-    "🔫 Опыт за успешный грабёж", "🔫 Опыт за провал грабежа", "🛡 Опыт за защиту",
-    "👥 Опыт за победу в 21", "👥 Опыт за поражение в 21", "📈 Множитель опыта для уровня",
-    "💰 Базовая награда за уровень (монеты)", "⭐️ Базовая награда за уровень (репутация)",
-    "📈 Инкремент награды (монеты)", "⭐️ Инкремент награды (репутация)",
-    "🎯 Бонус репутации к грабежу (%)", "🛡 Бонус репутации к защите (%)",
-    "👾 Шанс появления босса (%)", "⏱ Мин. интервал между боссами (мин)",
-    "📊 Макс. боссов в день", "❤️ Множитель HP босса", "⚔️ Кулдаун атаки (мин)",
-    "💥 Базовый урон игрока", "💰 Базовая награда за босса", "💰 Вариация награды",
-    "🎁 Глобальный лимит подгона в день", "⏱ Кулдаун подгона (мин)",
-    "💪 Силы за уровень", "🏃 Ловкости за уровень", "🛡 Защиты за уровень"
-])
+# Подписи кнопок настроек -> ключи в таблице settings
+_SETTING_KEY_MAP = {
+    "💰 Стоимость случайной кражи": "random_attack_cost",
+    "👤 Стоимость кражи по username": "targeted_attack_cost",
+    "⏱ Кулдаун (минут)": "theft_cooldown_minutes",
+    "🎲 Шанс успеха %": "theft_success_chance",
+    "🛡 Шанс защиты %": "theft_defense_chance",
+    "💥 Штраф при защите": "theft_defense_penalty",
+    "🎰 Шанс казино %": "casino_win_chance",
+    "💰 Мин. сумма кражи": "min_theft_amount",
+    "💰 Макс. сумма кражи": "max_theft_amount",
+    "🎲 Множитель костей": "dice_multiplier",
+    "🔢 Множитель угадайки": "guess_multiplier",
+    "⭐️ Репутация за угадайку": "guess_reputation",
+    "📢 Уведомления в чатах": "chat_notify_big_win",
+    "💰 Сумма подарка в чате": "gift_amount",
+    "📊 Лимит подарков в день": "gift_limit_per_day",
+    "👥 Реферальный бонус (монеты)": "referral_bonus",
+    "⭐️ Реферальный бонус (репутация)": "referral_reputation",
+    "📈 Опыт за казино (победа)": "exp_per_casino_win",
+    "📉 Опыт за казино (поражение)": "exp_per_casino_lose",
+    "🎲 Опыт за кости (победа)": "exp_per_dice_win",
+    "🎲 Опыт за кости (поражение)": "exp_per_dice_lose",
+    "🔢 Опыт за угадайку (победа)": "exp_per_guess_win",
+    "🔢 Опыт за угадайку (поражение)": "exp_per_guess_lose",
+    "🔫 Опыт за успешный грабёж": "exp_per_theft_success",
+    "🔫 Опыт за провал грабежа": "exp_per_theft_fail",
+    "🛡 Опыт за защиту": "exp_per_theft_defense",
+    "👥 Опыт за победу в 21": "exp_per_game_win",
+    "👥 Опыт за поражение в 21": "exp_per_game_lose",
+    "📈 Множитель опыта для уровня": "level_multiplier",
+    "💰 Базовая награда за уровень (монеты)": "level_reward_coins",
+    "⭐️ Базовая награда за уровень (репутация)": "level_reward_reputation",
+    "📈 Инкремент награды (монеты)": "level_reward_coins_increment",
+    "⭐️ Инкремент награды (репутация)": "level_reward_reputation_increment",
+    "🎯 Бонус репутации к грабежу (%)": "reputation_theft_bonus",
+    "🛡 Бонус репутации к защите (%)": "reputation_defense_bonus",
+    "👾 Шанс появления босса (%)": "boss_spawn_chance",
+    "⏱ Мин. интервал между боссами (мин)": "boss_min_interval",
+    "📊 Макс. боссов в день": "boss_max_per_day",
+    "❤️ Множитель HP босса": "boss_hp_multiplier",
+    "⚔️ Кулдаун атаки (мин)": "boss_attack_cooldown",
+    "💥 Базовый урон игрока": "boss_base_damage",
+    "💰 Базовая награда за босса": "boss_reward_coins",
+    "💰 Вариация награды": "boss_reward_coins_variance",
+    "🎁 Глобальный лимит подгона в день": "gift_global_limit_per_user",
+    "⏱ Кулдаун подгона (мин)": "gift_cooldown",
+    "💪 Силы за уровень": "stat_strength_per_level",
+    "🏃 Ловкости за уровень": "stat_agility_per_level",
+    "🛡 Защиты за уровень": "stat_defense_per_level",
+}
+_SETTING_LABELS = frozenset(_SETTING_KEY_MAP)
+
+@dp.message_handler(lambda message: message.text in _SETTING_LABELS)
 async def settings_edit_start(message: types.Message, state: FSMContext):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может изменять настройки.")
         return
-    key_map = {
-        "💰 Стоимость случайной кражи": "random_attack_cost",
-        "👤 Стоимость кражи по username": "targeted_attack_cost",
-        "⏱ Кулдаун (минут)": "theft_cooldown_minutes",
-        "🎲 Шанс успеха %": "theft_success_chance",
-        "🛡 Шанс защиты %": "theft_defense_chance",
-        "💥 Штраф при защите": "theft_defense_penalty",
-        "🎰 Шанс казино %": "casino_win_chance",
-        "💰 Мин. сумма кражи": "min_theft_amount",
-        "💰 Макс. сумма кражи": "max_theft_amount",
-        "🎲 Множитель костей": "dice_multiplier",
-        "🔢 Множитель угадайки": "guess_multiplier",
-        "⭐️ Репутация за угадайку": "guess_reputation",
-        "📢 Уведомления в чатах": "chat_notify_big_win",
-        "💰 Сумма подарка в чате": "gift_amount",
-        "📊 Лимит подарков в день": "gift_limit_per_day",
-        "👥 Реферальный бонус (монеты)": "referral_bonus",
-        "⭐️ Реферальный бонус (репутация)": "referral_reputation",
-        "📈 Опыт за казино (победа)": "exp_per_casino_win",
-        "📉 Опыт за казино (поражение)": "exp_per_casino_lose",
-        "🎲 Опыт за кости (победа)": "exp_per_dice_win",
-        "🎲 Опыт за кости (поражение)": "exp_per_dice_lose",
-        "🔢 Опыт за угадайку (победа)": "exp_per_guess_win",
-        "🔢 Опыт за угадайку (поражение)": "exp_per_guess_lose",
-        "🔫 Опыт за успешный грабёж": "exp_per_theft_success",
-        "🔫 Опыт за провал грабежа": "exp_per_theft_fail",
-        "🛡 Опыт за защиту": "exp_per_theft_defense",
-        "👥 Опыт за победу в 21": "exp_per_game_win",
-        "👥 Опыт за поражение в 21": "exp_per_game_lose",
-        "📈 Множитель опыта для уровня": "level_multiplier",
-        "💰 Базовая награда за уровень (монеты)": "level_reward_coins",
-        "⭐️ Базовая награда за уровень (репутация)": "level_reward_reputation",
-        "📈 Инкремент награды (монеты)": "level_reward_coins_increment",
-        "⭐️ Инкремент награды (репутация)": "level_reward_reputation_increment",
-        "🎯 Бонус репутации к грабежу (%)": "reputation_theft_bonus",
-        "🛡 Бонус репутации к защите (%)": "reputation_defense_bonus",
-        "👾 Шанс появления босса (%)": "boss_spawn_chance",
-        "⏱ Мин. интервал между боссами (мин)": "boss_min_interval",
-        "📊 Макс. боссов в день": "boss_max_per_day",
-        "❤️ Множитель HP босса": "boss_hp_multiplier",
-        "⚔️ Кулдаун атаки (мин)": "boss_attack_cooldown",
-        "💥 Базовый урон игрока": "boss_base_damage",
-        "💰 Базовая награда за босса": "boss_reward_coins",
-        "💰 Вариация награды": "boss_reward_coins_variance",
-        "🎁 Глобальный лимит подгона в день": "gift_global_limit_per_user",
-        "⏱ Кулдаун подгона (мин)": "gift_cooldown",
-        "💪 Силы за уровень": "stat_strength_per_level",
-        "🏃 Ловкости за уровень": "stat_agility_per_level",
-        "🛡 Защиты за уровень": "stat_defense_per_level",
-    }
-    key = key_map.get(message.text)
+    key = _SETTING_KEY_MAP.get(message.text)
     if not key:
         return
     await state.update_data(setting_key=key)
-    await message.answer(f"Введи новое значение для параметра (целое число):", reply_markup=back_keyboard())
+    await message.answer(f"Введи новое значение для параметра (целое число):", reply_markup=BACK_KB)
     await EditSettings.key.set()
 
 @dp.message_handler(state=EditSettings.key)
@@ -5002,36 +5419,45 @@ async def stats_handler(message: types.Message):
         return
     try:
         async with db_pool.acquire() as conn:
-            users = await conn.fetchval("SELECT COUNT(*) FROM users")
-            total_balance = await conn.fetchval("SELECT SUM(balance) FROM users") or 0
-            total_reputation = await conn.fetchval("SELECT SUM(reputation) FROM users") or 0
-            total_spent = await conn.fetchval("SELECT SUM(total_spent) FROM users") or 0
-            active_giveaways = await conn.fetchval("SELECT COUNT(*) FROM giveaways WHERE status='active'") or 0
-            shop_items = await conn.fetchval("SELECT COUNT(*) FROM shop_items") or 0
-            purchases_pending = await conn.fetchval("SELECT COUNT(*) FROM purchases WHERE status='pending'") or 0
-            purchases_completed = await conn.fetchval("SELECT COUNT(*) FROM purchases WHERE status='completed'") or 0
-            total_thefts = await conn.fetchval("SELECT SUM(theft_attempts) FROM users") or 0
-            total_thefts_success = await conn.fetchval("SELECT SUM(theft_success) FROM users") or 0
-            promos = await conn.fetchval("SELECT COUNT(*) FROM promocodes") or 0
-            banned = await conn.fetchval("SELECT COUNT(*) FROM banned_users") or 0
-            total_bosses = await conn.fetchval("SELECT COUNT(*) FROM bosses") or 0
-            active_bosses = await conn.fetchval("SELECT COUNT(*) FROM bosses WHERE status='active'") or 0
-            confirmed_chats = await conn.fetchval("SELECT COUNT(*) FROM confirmed_chats") or 0
+            row = await conn.fetchrow('''
+                SELECT u.users, u.total_balance, u.total_reputation, u.total_spent,
+                       u.total_thefts, u.total_thefts_success,
+                       p.purchases_pending, p.purchases_completed,
+                       b.total_bosses, b.active_bosses,
+                       (SELECT COUNT(*) FROM giveaways WHERE status='active') AS active_giveaways,
+                       (SELECT COUNT(*) FROM shop_items) AS shop_items,
+                       (SELECT COUNT(*) FROM promocodes) AS promos,
+                       (SELECT COUNT(*) FROM banned_users) AS banned,
+                       (SELECT COUNT(*) FROM confirmed_chats) AS confirmed_chats
+                FROM (SELECT COUNT(*) AS users,
+                             COALESCE(SUM(balance), 0) AS total_balance,
+                             COALESCE(SUM(reputation), 0) AS total_reputation,
+                             COALESCE(SUM(total_spent), 0) AS total_spent,
+                             COALESCE(SUM(theft_attempts), 0) AS total_thefts,
+                             COALESCE(SUM(theft_success), 0) AS total_thefts_success
+                      FROM users) u,
+                     (SELECT COUNT(*) FILTER (WHERE status='pending') AS purchases_pending,
+                             COUNT(*) FILTER (WHERE status='completed') AS purchases_completed
+                      FROM purchases) p,
+                     (SELECT COUNT(*) AS total_bosses,
+                             COUNT(*) FILTER (WHERE status='active') AS active_bosses
+                      FROM bosses) b
+            ''')
         text = (
             f"📊 Статистика:\n"
-            f"👥 Пользователей: {users}\n"
-            f"💰 Всего монет: {total_balance}\n"
-            f"⭐️ Всего репутации: {total_reputation}\n"
-            f"💸 Всего потрачено: {total_spent}\n"
-            f"🎁 Активных розыгрышей: {active_giveaways}\n"
-            f"🛒 Товаров в магазине: {shop_items}\n"
-            f"🛍️ Ожидающих покупок: {purchases_pending}\n"
-            f"✅ Выполненных покупок: {purchases_completed}\n"
-            f"🔫 Всего ограблений: {total_thefts} (успешно: {total_thefts_success})\n"
-            f"🎫 Промокодов создано: {promos}\n"
-            f"⛔ Заблокировано: {banned}\n"
-            f"👾 Всего боссов: {total_bosses} (активных: {active_bosses})\n"
-            f"✅ Подтверждённых чатов: {confirmed_chats}"
+            f"👥 Пользователей: {row['users']}\n"
+            f"💰 Всего монет: {row['total_balance']}\n"
+            f"⭐️ Всего репутации: {row['total_reputation']}\n"
+            f"💸 Всего потрачено: {row['total_spent']}\n"
+            f"🎁 Активных розыгрышей: {row['active_giveaways']}\n"
+            f"🛒 Товаров в магазине: {row['shop_items']}\n"
+            f"🛍️ Ожидающих покупок: {row['purchases_pending']}\n"
+            f"✅ Выполненных покупок: {row['purchases_completed']}\n"
+            f"🔫 Всего ограблений: {row['total_thefts']} (успешно: {row['total_thefts_success']})\n"
+            f"🎫 Промокодов создано: {row['promos']}\n"
+            f"⛔ Заблокировано: {row['banned']}\n"
+            f"👾 Всего боссов: {row['total_bosses']} (активных: {row['active_bosses']})\n"
+            f"✅ Подтверждённых чатов: {row['confirmed_chats']}"
         )
         await message.answer(text, reply_markup=admin_main_keyboard(await is_super_admin(message.from_user.id)))
     except Exception as e:
@@ -5044,7 +5470,7 @@ async def broadcast_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может делать рассылку.")
         return
-    await message.answer("Отправь сообщение для рассылки (текст, фото, видео или документ).", reply_markup=back_keyboard())
+    await message.answer("Отправь сообщение для рассылки (текст, фото, видео или документ).", reply_markup=BACK_KB)
     await Broadcast.media.set()
 
 @dp.message_handler(state=Broadcast.media, content_types=['text', 'photo', 'video', 'document'])
@@ -5055,22 +5481,15 @@ async def broadcast_media(message: types.Message, state: FSMContext):
         await message.answer("Панель администратора:", reply_markup=admin_main_keyboard(super_admin))
         return
 
-    content = {}
+    # Метод отправки и его аргументы выбираются один раз, а не для каждого получателя
     if message.text:
-        content['type'] = 'text'
-        content['text'] = message.text
+        send_fn, send_kwargs = bot.send_message, {'text': message.text}
     elif message.photo:
-        content['type'] = 'photo'
-        content['file_id'] = message.photo[-1].file_id
-        content['caption'] = message.caption or ""
+        send_fn, send_kwargs = bot.send_photo, {'photo': message.photo[-1].file_id, 'caption': message.caption or ""}
     elif message.video:
-        content['type'] = 'video'
-        content['file_id'] = message.video.file_id
-        content['caption'] = message.caption or ""
+        send_fn, send_kwargs = bot.send_video, {'video': message.video.file_id, 'caption': message.caption or ""}
     elif message.document:
-        content['type'] = 'document'
-        content['file_id'] = message.document.file_id
-        content['caption'] = message.caption or ""
+        send_fn, send_kwargs = bot.send_document, {'document': message.document.file_id, 'caption': message.caption or ""}
     else:
         await message.answer("Неподдерживаемый тип.")
         return
@@ -5079,26 +5498,45 @@ async def broadcast_media(message: types.Message, state: FSMContext):
 
     status_msg = await message.answer("⏳ Рассылка начата... Это может занять некоторое время.")
 
+    recipients_query = (
+        "SELECT u.user_id FROM users u LEFT JOIN banned_users b ON b.user_id = u.user_id "
+        "WHERE b.user_id IS NULL AND u.user_id > $1 ORDER BY u.user_id LIMIT $2"
+    )
     async with db_pool.acquire() as conn:
-        users = await conn.fetch("SELECT user_id FROM users")
-        users = [r['user_id'] for r in users]
+        # Только для прогресса: пока идёт рассылка, число пользователей может измениться
+        total = await conn.fetchval(
+            "SELECT COUNT(*) FROM users u LEFT JOIN banned_users b ON b.user_id = u.user_id WHERE b.user_id IS NULL"
+        )
 
     sent = 0
     failed = 0
-    total = len(users)
-
-    for i, uid in enumerate(users):
-        if await is_banned(uid):
-            continue
+    processed = 0
+    # Ограниченная очередь: получатели подгружаются порциями по мере отправки,
+    # а не все сразу в память
+    queue = asyncio.Queue(maxsize=BROADCAST_FETCH_BATCH)
+
+    async def produce():
+        last_id = 0
+        while True:
+            async with db_pool.acquire() as conn:
+                rows = await conn.fetch(recipients_query, last_id, BROADCAST_FETCH_BATCH)
+            for row in rows:
+                await queue.put(row['user_id'])
+            if len(rows) < BROADCAST_FETCH_BATCH:
+                break
+            last_id = rows[-1]['user_id']
+        for _ in range(BROADCAST_CONCURRENCY):
+            await queue.put(None)
+
+    async def deliver(uid):
+        await send_fn(uid, **send_kwargs)
+
+    async def send_one(uid):
+        # Ловим только ошибки Telegram/сети (NetworkError — тоже TelegramAPIError);
+        # CancelledError и прочее летит дальше, чтобы остановка бота не зависала на рассылке
+        nonlocal sent, failed
         try:
-            if content['type'] == 'text':
-                await bot.send_message(uid, content['text'])
-            elif content['type'] == 'photo':
-                await bot.send_photo(uid, content['file_id'], caption=content['caption'])
-            elif content['type'] == 'video':
-                await bot.send_video(uid, content['file_id'], caption=content['caption'])
-            elif content['type'] == 'document':
-                await bot.send_document(uid, content['file_id'], caption=content['caption'])
+            await deliver(uid)
             sent += 1
         except (BotBlocked, UserDeactivated, ChatNotFound):
             failed += 1
@@ -5106,31 +5544,49 @@ async def broadcast_media(message: types.Message, state: FSMContext):
             logging.warning(f"Flood limit, waiting {e.timeout} seconds")
             await asyncio.sleep(e.timeout)
             try:
-                if content['type'] == 'text':
-                    await bot.send_message(uid, content['text'])
-                else:
-                    if content['type'] == 'photo':
-                        await bot.send_photo(uid, content['file_id'], caption=content['caption'])
-                    elif content['type'] == 'video':
-                        await bot.send_video(uid, content['file_id'], caption=content['caption'])
-                    elif content['type'] == 'document':
-                        await bot.send_document(uid, content['file_id'], caption=content['caption'])
+                await deliver(uid)
                 sent += 1
-            except:
+            except (TelegramAPIError, asyncio.TimeoutError) as ex:
                 failed += 1
-        except Exception as e:
+                logging.warning(f"Failed to send to {uid} after retry: {ex}")
+        except (TelegramAPIError, asyncio.TimeoutError) as e:
             failed += 1
             logging.warning(f"Failed to send to {uid}: {e}")
 
-        if (i + 1) % 10 == 0:
+    async def worker():
+        nonlocal processed
+        # None в очереди — получатели закончились
+        while (uid := await queue.get()) is not None:
+            await tg_limiter.acquire(uid)
+            await send_one(uid)
+            processed += 1
+
+    async def report_progress():
+        # Прогресс по таймеру, а не по счётчику: воркеры не ждут edit_text,
+        # и сообщение не правится чаще, чем это разрешает Telegram
+        shown = 0
+        while True:
+            await asyncio.sleep(BROADCAST_STATUS_INTERVAL)
+            if processed == shown:
+                continue
+            shown = processed
             try:
-                await status_msg.edit_text(f"⏳ Прогресс: {i+1}/{total}\n✅ Отправлено: {sent}\n❌ Ошибок: {failed}")
-            except:
-                pass
+                await status_msg.edit_text(f"⏳ Прогресс: {processed}/{total}\n✅ Отправлено: {sent}\n❌ Ошибок: {failed}")
+            except TelegramAPIError as e:
+                logging.warning(f"Broadcast progress update failed: {e}")
 
-        await asyncio.sleep(0.05)
+    reporter = asyncio.create_task(report_progress())
+    workers = [asyncio.create_task(worker()) for _ in range(BROADCAST_CONCURRENCY)]
+    workers.append(asyncio.create_task(produce()))
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        # При отмене или ошибке в одном воркере остальные не должны продолжать рассылку
+        reporter.cancel()
+        for w in workers:
+            w.cancel()
 
-    await status_msg.edit_text(f"✅ Рассылка завершена!\n📊 Отправлено: {sent}\n❌ Ошибок: {failed}\n👥 Всего: {total}")
+    await status_msg.edit_text(f"✅ Рассылка завершена!\n📊 Отправлено: {sent}\n❌ Ошибок: {failed}\n👥 Всего: {processed}")
 
 # ----- Блокировки -----
 @dp.message_handler(lambda message: message.text == "🔨 Блокировки")
@@ -5145,7 +5601,7 @@ async def block_user_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может блокировать пользователей.")
         return
-    await message.answer("Введи ID или @username пользователя для блокировки:", reply_markup=back_keyboard())
+    await message.answer("Введи ID или @username пользователя для блокировки:", reply_markup=BACK_KB)
     await BlockUser.user_id.set()
 
 @dp.message_handler(state=BlockUser.user_id)
@@ -5179,11 +5635,13 @@ async def block_user_reason(message: types.Message, state: FSMContext):
     try:
         async with db_pool.acquire() as conn:
             await conn.execute(
-                "INSERT INTO banned_users (user_id, banned_by, banned_date, reason) VALUES ($1, $2, $3, $4) ON CONFLICT (user_id) DO NOTHING",
-                uid, message.from_user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), reason
+                "INSERT INTO banned_users (user_id, banned_by, reason) VALUES ($1, $2, $3) ON CONFLICT (user_id) DO NOTHING",
+                uid, message.from_user.id, reason
             )
+        if banned_ids_cache is not None:
+            banned_ids_cache.add(uid)
         await message.answer(f"✅ Пользователь {uid} заблокирован.")
-        await safe_send_message(uid, f"⛔ Вы заблокированы в боте. Причина: {reason if reason else 'не указана'}")
+        safe_send_message_task(uid, f"⛔ Вы заблокированы в боте. Причина: {reason if reason else 'не указана'}")
     except Exception as e:
         logging.error(f"Block user error: {e}")
         await message.answer("❌ Ошибка.")
@@ -5194,7 +5652,7 @@ async def unblock_user_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("❌ Только суперадмин может разблокировать пользователей.")
         return
-    await message.answer("Введи ID или @username пользователя для разблокировки:", reply_markup=back_keyboard())
+    await message.answer("Введи ID или @username пользователя для разблокировки:", reply_markup=BACK_KB)
     await UnblockUser.user_id.set()
 
 @dp.message_handler(state=UnblockUser.user_id)
@@ -5211,8 +5669,10 @@ async def unblock_user_finish(message: types.Message, state: FSMContext):
     try:
         async with db_pool.acquire() as conn:
             await conn.execute("DELETE FROM banned_users WHERE user_id=$1", uid)
+        if banned_ids_cache is not None:
+            banned_ids_cache.discard(uid)
         await message.answer(f"✅ Пользователь {uid} разблокирован.")
-        await safe_send_message(uid, "🔓 Вы разблокированы в боте.")
+        safe_send_message_task(uid, "🔓 Вы разблокированы в боте.")
     except Exception as e:
         logging.error(f"Unblock user error: {e}")
         await message.answer("❌ Ошибка.")
@@ -5245,7 +5705,7 @@ async def add_admin_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("Только суперадмин может добавлять админов.")
         return
-    await message.answer("Введи ID или @username пользователя, которого хочешь сделать младшим админом:", reply_markup=back_keyboard())
+    await message.answer("Введи ID или @username пользователя, которого хочешь сделать младшим админом:", reply_markup=BACK_KB)
     await AddJuniorAdmin.user_id.set()
 
 @dp.message_handler(state=AddJuniorAdmin.user_id)
@@ -5261,13 +5721,16 @@ async def add_admin_finish(message: types.Message, state: FSMContext):
     uid = user_data['user_id']
     try:
         async with db_pool.acquire() as conn:
-            await conn.execute(
-                "INSERT INTO admins (user_id, added_by, added_date) VALUES ($1, $2, $3)",
-                uid, message.from_user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            inserted = await conn.fetchval(
+                "INSERT INTO admins (user_id, added_by) VALUES ($1, $2) ON CONFLICT (user_id) DO NOTHING RETURNING user_id",
+                uid, message.from_user.id
             )
-        await message.answer(f"✅ Пользователь {uid} теперь младший админ.")
-    except asyncpg.UniqueViolationError:
-        await message.answer("❌ Этот пользователь уже админ.")
+        if inserted is None:
+            await message.answer("❌ Этот пользователь уже админ.")
+        else:
+            if admin_ids_cache is not None:
+                admin_ids_cache.add(uid)
+            await message.answer(f"✅ Пользователь {uid} теперь младший админ.")
     except Exception as e:
         logging.error(f"Add admin error: {e}")
         await message.answer("❌ Ошибка.")
@@ -5278,7 +5741,7 @@ async def remove_admin_start(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         await message.answer("Только суперадмин может удалять админов.")
         return
-    await message.answer("Введи ID или @username пользователя, которого хочешь лишить прав админа:", reply_markup=back_keyboard())
+    await message.answer("Введи ID или @username пользователя, которого хочешь лишить прав админа:", reply_markup=BACK_KB)
     await RemoveJuniorAdmin.user_id.set()
 
 @dp.message_handler(state=RemoveJuniorAdmin.user_id)
@@ -5295,6 +5758,8 @@ async def remove_admin_finish(message: types.Message, state: FSMContext):
     try:
         async with db_pool.acquire() as conn:
             await conn.execute("DELETE FROM admins WHERE user_id=$1", uid)
+        if admin_ids_cache is not None:
+            admin_ids_cache.discard(uid)
         await message.answer(f"✅ Пользователь {uid} больше не админ, если был им.")
     except Exception as e:
         logging.error(f"Remove admin error: {e}")
@@ -5320,46 +5785,95 @@ async def list_admins(message: types.Message):
 async def cleanup_old_data(message: types.Message):
     if not await is_super_admin(message.from_user.id):
         return
-    async with db_pool.acquire() as conn:
-        await conn.execute("DELETE FROM bosses WHERE status IN ('defeated', 'expired') AND spawned_at < NOW() - INTERVAL '7 days'")
-        await conn.execute("DELETE FROM boss_attacks WHERE attack_time < NOW() - INTERVAL '7 days'")
-        await conn.execute("DELETE FROM giveaways WHERE status='completed' AND end_date < NOW() - INTERVAL '30 days'")
-    await message.answer("✅ Старые записи очищены.")
+    # Одна транзакция на все три удаления
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM bosses WHERE status IN ('defeated', 'expired') AND spawned_at < NOW() - INTERVAL '7 days'")
+                await conn.execute("DELETE FROM boss_attacks WHERE attack_time < NOW() - INTERVAL '7 days'")
+                await conn.execute("DELETE FROM giveaways WHERE status='completed' AND end_date < NOW() - INTERVAL '30 days'")
+        await message.answer("✅ Старые записи очищены.")
+    except Exception as e:
+        logging.error(f"Cleanup error: {e}")
+        await message.answer("❌ Ошибка при очистке.")
 
 # ===== ФОНОВЫЕ ЗАДАЧИ =====
+# Подтверждение чата, ночной сброс счётчиков и смена boss_* настроек будят boss_spawn_loop
+boss_spawn_wakeup = asyncio.Event()
+
 async def boss_spawn_loop():
+    # Шанс появления бросается раз в 5 минут, но только пока есть чат, где босс может появиться.
+    # Если все чаты упёрлись в дневной лимит или интервал (или чатов нет), спим до ближайшего
+    # момента, когда это изменится, но не дольше часа; события выше будят раньше
+    delay = 300
     while True:
-        await asyncio.sleep(300)  # каждые 5 минут
+        boss_spawn_wakeup.clear()
         try:
-            confirmed = await get_confirmed_chats()
+            await asyncio.wait_for(boss_spawn_wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        delay = 300
+        try:
+            # Время следующего шанса считается по boss_spawn_count и boss_last_spawn —
+            # берём их из БД, а не из кэша, который может отставать на 5 минут
+            confirmed = await get_confirmed_chats(force_update=True)
             now = datetime.now()
+            boss_max_per_day = int(await get_setting("boss_max_per_day"))
+            min_interval = int(await get_setting("boss_min_interval"))
+            chance = int(await get_setting("boss_spawn_chance"))
+            next_eligible = now + timedelta(hours=1)
+            any_eligible = False
             for chat_id, data in confirmed.items():
-                boss_max_per_day = int(await get_setting("boss_max_per_day"))
                 boss_spawn_count = data.get('boss_spawn_count', 0)
                 if boss_spawn_count >= boss_max_per_day:
+                    # Счётчик обнуляет reset_daily_limits в полночь
+                    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+                    next_eligible = min(next_eligible, midnight)
                     continue
                 last_spawn_str = data.get('boss_last_spawn')
                 if last_spawn_str:
-                    last_spawn = datetime.strptime(last_spawn_str, "%Y-%m-%d %H:%M:%S")
-                    min_interval = int(await get_setting("boss_min_interval"))
-                    if (now - last_spawn).total_seconds() < min_interval * 60:
+                    ready_at = datetime.strptime(last_spawn_str, "%Y-%m-%d %H:%M:%S") + timedelta(minutes=min_interval)
+                    if ready_at > now:
+                        next_eligible = min(next_eligible, ready_at)
                         continue
-                chance = int(await get_setting("boss_spawn_chance"))
+                any_eligible = True
                 if random.randint(1, 100) <= chance:
                     await spawn_boss(chat_id)
+            if not any_eligible:
+                delay = max(delay, (next_eligible - now).total_seconds())
         except Exception as e:
             logging.error(f"Boss spawn loop error: {e}")
 
+# spawn_boss будит check_expired_bosses, чтобы тот пересчитал, когда истекает ближайший босс
+boss_expiry_wakeup = asyncio.Event()
+
 async def check_expired_bosses():
+    # Вместо опроса раз в 10 минут спим ровно до истечения ближайшего активного босса;
+    # раз в час всё равно проходим — это подчищает старые expired и страхует от пропусков
     while True:
-        await asyncio.sleep(600)  # каждые 10 минут
+        boss_expiry_wakeup.clear()
+        nearest = None
         try:
+            # Один запрос вместо трёх: все части видят один снимок, поэтому ближайший срок
+            # ищем среди ещё не истёкших, а только что истёкших удалит следующий проход
+            now = datetime.now()
             async with db_pool.acquire() as conn:
-                now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                await conn.execute("UPDATE bosses SET status='expired' WHERE status='active' AND expires_at < $1", now)
-                await conn.execute("DELETE FROM bosses WHERE status='expired' AND expires_at < $1", (datetime.now() - timedelta(hours=2)).strftime("%Y-%m-%d %H:%M:%S"))
+                nearest = await conn.fetchval(
+                    "WITH expired AS (UPDATE bosses SET status='expired' WHERE status='active' AND expires_at < $1), "
+                    "purged AS (DELETE FROM bosses WHERE status='expired' AND expires_at < $2) "
+                    "SELECT MIN(expires_at) FROM bosses WHERE status='active' AND expires_at >= $1",
+                    now, now - timedelta(hours=2)
+                )
         except Exception as e:
             logging.error(f"Check expired bosses error: {e}")
+        timeout = 3600
+        if nearest:
+            until_nearest = (nearest - datetime.now()).total_seconds()
+            timeout = min(timeout, max(until_nearest + 1, 1))
+        try:
+            await asyncio.wait_for(boss_expiry_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
 async def reset_daily_limits():
     while True:
@@ -5371,6 +5885,7 @@ async def reset_daily_limits():
             async with db_pool.acquire() as conn:
                 await conn.execute("UPDATE users SET gift_count_today = 0")
                 await conn.execute("UPDATE confirmed_chats SET gift_count_today = 0, boss_spawn_count = 0")
+            boss_spawn_wakeup.set()
             logging.info("Daily limits reset.")
         except Exception as e:
             logging.error(f"Reset daily limits error: {e}")
@@ -5379,47 +5894,64 @@ async def reset_daily_limits():
 async def handle(request):
     return web.Response(text="Bot is running")
 
-async def start_web_server():
+def create_web_app():
     app = web.Application()
     app.router.add_get("/", handle)
-    runner = web.AppRunner(app)
+    return app
+
+async def start_web_server():
+    runner = web.AppRunner(create_web_app())
     await runner.setup()
-    port = int(os.environ.get("PORT", 8080))
-    site = web.TCPSite(runner, "0.0.0.0", port)
+    site = web.TCPSite(runner, "0.0.0.0", PORT)
     await site.start()
-    logging.info(f"Web server started on port {port}")
+    logging.info(f"Web server started on port {PORT}")
 
 # ===== ЗАПУСК =====
 async def on_startup(dp):
-    await before_start()
-    await create_db_pool()
+    # Запрос к Telegram и подключение к БД друг от друга не зависят
+    await asyncio.gather(before_start(), create_db_pool())
     await init_db()
     asyncio.create_task(boss_spawn_loop())
     asyncio.create_task(check_expired_bosses())
     asyncio.create_task(reset_daily_limits())
-    asyncio.create_task(start_web_server())
+    if not WEBHOOK_HOST:
+        # На вебхуке health-check отдаёт то же приложение, что принимает обновления
+        asyncio.create_task(start_web_server())
     logging.info("🤖 Бот запущен и готов к работе!")
     logging.info(f"👑 Суперадмины: {SUPER_ADMINS}")
     logging.info(f"🗄 База данных: PostgreSQL")
 
-async def on_shutdown(dp):
-    await db_pool.close()
+async def close_storage():
     await storage.close()
-    await dp.storage.close()
-    await bot.close()
+    await storage.wait_closed()
+
+async def on_shutdown(dp):
+    # Буфер вставок пишется в БД, поэтому сбрасываем его до закрытия пула;
+    # остальное закрывается параллельно, ошибка одного не мешает другим
+    await insert_coalescer.flush_all()
+    results = await asyncio.gather(db_pool.close(), close_storage(), bot.close(), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logging.error(f"Shutdown error: {result}")
     logging.info("Бот остановлен")
 
 if __name__ == "__main__":
-    while True:
-        try:
-            executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
-        except TerminatedByOtherGetUpdates:
-            logging.error("Конфликт с другим экземпляром. Жду 5 сек...")
-            time.sleep(5)
-            continue
-        except Exception as e:
-            logging.error(f"Критическая ошибка: {e}")
-            time.sleep(5)
-            continue
+    if WEBHOOK_HOST:
+        webhook_executor = executor.set_webhook(
+            dp, WEBHOOK_PATH, on_startup=on_startup, on_shutdown=on_shutdown, web_app=create_web_app()
+        )
+        webhook_executor.run_app(host="0.0.0.0", port=PORT)
+    else:
+        while True:
+            try:
+                executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
+            except TerminatedByOtherGetUpdates:
+                logging.error("Конфликт с другим экземпляром. Жду 5 сек...")
+                time.sleep(5)
+                continue
+            except Exception as e:
+                logging.error(f"Критическая ошибка: {e}")
+                time.sleep(5)
+                continue
 
 # ===== КОНЕЦ КОДА =====
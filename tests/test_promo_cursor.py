@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+pytest.importorskip("aiogram")
+pytest.importorskip("asyncpg")
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/test")
+
+import main  # noqa: E402
+
+
+@pytest.mark.parametrize("code", ["SUMMER:2024", "ПРОМОКОД" * 5])
+def test_legacy_promo_code_cursor_fits_callback_data(code):
+    cursor = main.promo_cursor(code)
+    for direction in ("before", "after"):
+        data = main.promos_page_cb.new(direction=direction, code=cursor)
+        assert len(data.encode()) <= 64
+        assert main.promos_page_cb.parse(data)["code"] == cursor
+    assert cursor.startswith("#")
+
+
+def test_valid_promo_code_is_its_own_cursor():
+    assert main.promo_cursor("BONUS_100") == "BONUS_100"